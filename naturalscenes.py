@@ -15,6 +15,8 @@ import pdb as _ipdb
 import pandas as _pd
 from time import time as _time
 import pickle as _pickle
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+from multiprocessing import shared_memory as _shared_memory
 import pink_noise.pink_noise as _pn
 import os
 from loader.loader import *
@@ -57,9 +59,21 @@ g = None
 images_list = None
 tax = None
 
+# precision of g, the noise and the letters (and of 'linear_prediction' and 'linear_prediction_noise' on disk).
+# 'float32' halves memory and disk bandwidth, the model's own noise is far larger than float32 rounding errors.
+# Percentiles, covariances and log-determinants are always accumulated in float64
+sim_dtype = 'float64'
+
 # define parameters for analyzing words
 binsN = 16
 bin_rate = None
+save_ranks = False      # if True, process() also saves the rank of every letter, binned codes for any binsN
+                        # can then be computed with codes_from_ranks without going back to g
+mi_estimator = 'plugin' # entropy estimator used by process() (see _entropy), bias corrected estimators need fewer cells.
+                        # Results with other estimators are saved with the estimator's name appended (mi_8b_0g_nsb)
+mi_error_bars = None    # None, 'bootstrap' or 'jackknife'. If given, process() also saves the confidence interval of every
+                        # information curve (mi_8b_0g_lower, mi_8b_0g_upper), see mi_confidence
+mi_null_permutations = 0 # if > 0, process() also saves the 95% quantile of the shuffled MI (mi_8b_0g_null95), see mi_null
 
 # define center pathway parameters
 center_size = 1         # in degrees
@@ -113,16 +127,13 @@ def summary():
     bcell_nb            = 5
     added_noise_factor  = 1
     
-    for llength in [25, 50, 75]:
-        for letters_N in [2, 4, 8]:    # in ms
-
-            process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letters_N)
+    # all letter lengths (in ms) are computed in one pass over g and all word lengths in one pass over the letters
+    process_conditions(saccade_size, rw_step, bcell_nb, [added_noise_factor], [25, 50, 75], [2, 4, 8])
 
 
     llength = 50
     letters_N = 8
-    for added_noise_factor in [0.5, 2.0]:
-        process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letters_N)
+    process_conditions(saccade_size, rw_step, bcell_nb, [0.5, 2.0], llength, letters_N)
     #plot_summary()
 
 
@@ -244,11 +255,39 @@ def process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letter
     Do everything needed to generate all data in the paper for this condition
     
     '''
-    
-    folders = make_datafolders(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letters_N)
+    process_conditions(saccade_size, rw_step, bcell_nb, [added_noise_factor], llength, letters_N)
 
-    #_ipdb.set_trace()
-    letter_length = llength/1000
+def process_conditions(saccade_size, rw_step, bcell_nb, added_noise_factors, llengths, letters_N):
+    '''
+    Same as process() but evaluates several added_noise_factor values and letter lengths in one pass.
+
+    Conditions that only differ in added_noise_factor share g, the noise model and the
+    base noise draw (the noise is loaded from the 'FEM' folder anyway), the only thing
+    that changes is the scalar multiplying noise_std * noise. Here g and that term are
+    computed once and each condition writes its outputs into its own folder.
+    For each noise level, letters for all letter lengths come out of the same pass over g
+    (see _get_letters and average_pyramid)
+
+    inputs:
+    -------
+        added_noise_factors:    iterable of floats, one condition per value. Values are used
+                                as given to name the folders (1 and 1.0 are different folders)
+
+        llengths:               letter length in ms or iterable of letter lengths. Letter lengths do not need
+                                to be a multiple of sim_delta_t, extra points at the end of the simulation are dropped
+
+        letters_N:              number of letters per word or iterable of them. Information for all word lengths
+                                up to the largest one is computed in one pass (see _process_letters)
+    '''
+    added_noise_factors = list(added_noise_factors)
+    if not _np.iterable(llengths):
+        llengths = [llengths]
+    llengths = list(llengths)
+    if not _np.iterable(letters_N):
+        letters_N = [letters_N]
+    letters_N = list(letters_N)
+
+    folders = make_datafolders(saccade_size, rw_step, bcell_nb, added_noise_factors[0], llengths[0], letters_N[0])
 
     # generate a bipolar cell object.
     # It has three pathways, center, surround and periphery, each one can contribute
@@ -256,42 +295,177 @@ def process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letter
     # Then I can add noise to the noiseless mp that is consistent with Yusuf's intracellular recordings
     # Pass that noisy mp through a nonlinearity representing [Ca] concentration
     # Pass [Ca] through an adaptive block to represent vesicle release
-    bipolar = cell(bcell_nb, llength, added_noise_factor)
+    # The noise model is a linear fit to sim_mp_noise, which is proportional to added_noise_factor.
+    # I'm building the cell with added_noise_factor = 1 and scaling noise_std for each condition.
+    bipolar = cell(bcell_nb, llengths[0], 1)
 
     print('Loading or computing g')
     g = bipolar.processAllImages(folders)              # this will take several hours unless it is loading from a file
     
-    print('computing and adding noise to g')
-    noise_std = bipolar.noise_model(g.std(axis=0, keepdims=True))   # this is a function of time, the higher the
-                                                                    # effective contrast, the higher the noise
-    noise_std.tofile(os.path.join(folders['FEM'], 'gsd'))
-    noisy_g = g + added_noise_factor * noise_std * bipolar.get_noise(folders['FEM'], g.shape, save_flag=1, corr_time=None)
-    #noisy_g = g + added_noise_factor*noise_std*_np.random.randn(*g.shape)
-
-    # Compute letters at all times under all nonlinearities
-    print('Computing letters at all times under both basal and gating nonlinearities')
-    basal_letters = bipolar.nl_basal.torate(noisy_g)
-    gating_letters = bipolar.get_gating_letters(noisy_g)
-
-    #return letters (averaging over letter_length) for noisy_g, basal and gating responses.
-    noisy_g          = average(noisy_g, int(letter_length/sim_delta_t), 0)
-    basal_letters    = average(basal_letters, int(letter_length/sim_delta_t), 0)
-    gating_letters   = average(gating_letters, int(letter_length/sim_delta_t), 0)
+    print('computing noise for {0} noise levels'.format(len(added_noise_factors)))
+    unit_noise_std = bipolar.noise_model(g.std(axis=0, keepdims=True, dtype=float))  # this is a function of time, the higher the
+                                                                        # effective contrast, the higher the noise
+    # noise_term is unit_noise_std * noise, computed in place to avoid another array the size of g
+    noise_term = bipolar.get_noise(folders['FEM'], g.shape, save_flag=1, corr_time=None)
+    noise_term *= unit_noise_std
+
+    # number of simulation points in each letter, not necessarily an integer
+    pnts_list = [llength/(1000*sim_delta_t) for llength in llengths]
+
+    for added_noise_factor in added_noise_factors:
+        bipolar.added_noise_factor = added_noise_factor
+
+        print('adding noise to g, added_noise_factor = {0}'.format(added_noise_factor))
+        noise_std = added_noise_factor * unit_noise_std
+        noise_std.tofile(os.path.join(folders['FEM'], 'gsd'))
+
+        # noisy_g = g + added_noise_factor * noise_std * noise, where noise_std already carries one
+        # added_noise_factor from the noise model
+        # Compute letters at all times under all nonlinearities
+        print('Computing letters at all times under both basal and gating nonlinearities')
+        letters_list = _get_letters(g, noise_term, added_noise_factor**2, bipolar, pnts_list)
+
+        for llength, (noisy_g, basal_letters, gating_letters) in zip(llengths, letters_list):
+            folders = make_datafolders(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letters_N[0])
+            _process_letters(noisy_g, basal_letters, gating_letters, folders, llength, letters_N)
+
+def process_gaussian(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, decay_time=None, maxImages=None, maxCellsPerImage=None):
+    '''
+    Gaussian counterpart of process(), information between g and g+noise computed from covariances only.
+    g is never loaded, covG comes from cell.get_covG (cached under folders['FEM']/covG)
+
+    inputs:
+    -------
+        decay_time:     noise correlation time in seconds (see getNoiseCovariance). Defaults to None, meaning
+                        uncorrelated noise as in process()
+
+        maxImages, maxCellsPerImage:    passed to cell.get_covG
+
+    output:
+    -------
+        gaussian_mi:        1D ndarray, I(g(p); g(p)+n) at every point, also saved under folders['llength']
+
+        gaussian_cond_mi:   1D ndarray, I(g(p); g(p)+n | g(p-k*llength)+n for k = 1, 2, ...) (see newInformation),
+                            also saved under folders['llength']
+    '''
+    folders = make_datafolders(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, 1)
+
+    # same noise as in process_conditions, a cell with added_noise_factor = 1 whose noise sd is scaled by
+    # added_noise_factor twice (once by the noise model and once when adding it)
+    bipolar = cell(bcell_nb, llength, 1)
+
+    print('Loading or computing covG')
+    covG = bipolar.get_covG(folders, maxImages, maxCellsPerImage)
+    covN = getNoiseCovariance(covG, bipolar.noise_model, decay_time, sparse=True) * added_noise_factor**4
+
+    gaussian_mi = _np.array([_getCondInfoP0(covG, covN, p, [], []) for p in range(covG.shape[0])])
+    gaussian_cond_mi = newInformation(covG, covN, llength/1000)
+
+    gaussian_mi.tofile(os.path.join(folders['llength'], 'gaussian_mi'))
+    gaussian_cond_mi.tofile(os.path.join(folders['llength'], 'gaussian_cond_mi'))
+
+    return gaussian_mi, gaussian_cond_mi
+
+def _get_letters(g, noise_term, noise_factor, bipolar, pnts_list, rows_per_chunk=10000):
+    '''
+    Fused version of adding noise to g, passing noisy g through the basal and gating nonlinearities
+    and averaging each of them over letters of 'pnts' points, for every pnts in pnts_list.
+
+    g is processed row-block by row-block, only 'rows_per_chunk' rows of noisy g and of the responses
+    exist at full (sim_delta_t) resolution at any given time. Only the letters are kept.
+    Letters of all lengths are computed from the same cumulative sums (see average_pyramid).
+
+    inputs:
+    -------
+        g:              2D ndarray, the linear prediction, g[i,j] is cell i at time point j
+
+        noise_term:     2D ndarray, same shape as g, noise_std * noise
+
+        noise_factor:   float, noisy g is g + noise_factor * noise_term
+
+        bipolar:        cell object, provides nl_basal and get_gating_letters
+
+        pnts_list:      iterable with the number of points in a letter (floats are fine).
+                        Extra points at the end of g are dropped (average_pyramid's flag 1)
+
+    output:
+    -------
+        letters_list:   list with one tuple per element in pnts_list, each tuple has
+
+                        noisy_g:        2D ndarray, noisy g averaged over letters, shape is (g.shape[0], lettersN)
+
+                        basal_letters:  idem noisy_g, for responses under the basal nl
+
+                        gating_letters: idem noisy_g, for responses under the gating nl
+    '''
+    cellsN = g.shape[0]
+    letters_list = []
+    for pnts in pnts_list:
+        shape_out = (cellsN, _letters_number(g.shape[1], pnts, 1))
+        letters_list.append(tuple(_np.empty(shape_out, dtype=g.dtype) for i in range(3)))
+
+    # buffers at full resolution, reused for every block
+    rows_per_chunk = min(rows_per_chunk, cellsN)
+    noisy_block = _np.empty((rows_per_chunk, g.shape[1]), dtype=g.dtype)
+    resp_block = _np.empty_like(noisy_block)
+
+    for start in range(0, cellsN, rows_per_chunk):
+        end = min(start + rows_per_chunk, cellsN)
+        noisy = noisy_block[:end-start]
+        resp = resp_block[:end-start]
+
+        _np.multiply(noise_term[start:end], noise_factor, out=noisy)
+        noisy += g[start:end]
+
+        # i = 0 is noisy g, 1 is basal and 2 is gating responses. Basal and gating share the resp buffer
+        for i in range(3):
+            if i == 0:
+                block = noisy
+            elif i == 1:
+                block = bipolar.nl_basal.torate(noisy, out=resp)
+            else:
+                block = bipolar.get_gating_letters(noisy, out=resp)
+
+            for letters, averaged in zip(letters_list, average_pyramid(block, pnts_list, 1)):
+                letters[i][start:end] = averaged
+
+    return letters_list
+
+def _process_letters(noisy_g, basal_letters, gating_letters, folders, llength, letters_N):
+    '''
+    Everything in process() that happens after letters are computed: firing rates, binning and
+    information calculations.
+
+    noisy_g, basal_letters and gating_letters are already averaged over letters (output of _get_letters).
+    All outputs are written to the folders in 'folders', information for k letter words is written to the
+    '{k}Letters' folder inside folders['llength'], for every k up to max(letters_N)
+
+    letters_N can be an int or a list of ints. The information for all word lengths up to max(letters_N) comes out
+    of a single call. Words of every length, including the joint (g, letter) words, are one int64 per sample and are
+    grown one letter at a time from the previous length (see _grow_words, hashed when they do not fit), codes never
+    go through np.unique over the whole array.
+    '''
+    if not _np.iterable(letters_N):
+        letters_N = [letters_N]
+
+    letter_length = llength/1000
+
     preSacP = int((-.1-sim_start_t)/letter_length)
     postSacP = int((.1-sim_start_t)/letter_length)
     
 
     # Compute average firing rate under basal and gating
-    basal_fr = basal_letters.mean(axis=0).tofile(os.path.join(folders['llength'],  'basal_fr'))
-    gating_fr = gating_letters.mean(axis=0).tofile(os.path.join(folders['llength'], 'gating_fr'))
+    # (these small arrays are always saved as float64, regardless of sim_dtype)
+    basal_fr = basal_letters.mean(axis=0, dtype=float).tofile(os.path.join(folders['llength'],  'basal_fr'))
+    gating_fr = gating_letters.mean(axis=0, dtype=float).tofile(os.path.join(folders['llength'], 'gating_fr'))
 
 
-    noisy_g[:, preSacP].tofile(os.path.join(folders['llength'], 'g_preSac_nobinning'))
-    basal_letters[:, preSacP].tofile(os.path.join(folders['llength'], 'basal_letters_preSac_nobinning'))
-    gating_letters[:, preSacP].tofile(os.path.join(folders['llength'], 'gating_letters_preSac_nobinning'))
-    noisy_g[:, postSacP].tofile(os.path.join(folders['llength'], 'g_postSac_nobinning'))
-    basal_letters[:, postSacP].tofile(os.path.join(folders['llength'], 'basal_letters_postSac_nobinning'))
-    gating_letters[:, postSacP].tofile(os.path.join(folders['llength'], 'gating_letters_postSac_nobinning'))
+    noisy_g[:, preSacP].astype(float).tofile(os.path.join(folders['llength'], 'g_preSac_nobinning'))
+    basal_letters[:, preSacP].astype(float).tofile(os.path.join(folders['llength'], 'basal_letters_preSac_nobinning'))
+    gating_letters[:, preSacP].astype(float).tofile(os.path.join(folders['llength'], 'gating_letters_preSac_nobinning'))
+    noisy_g[:, postSacP].astype(float).tofile(os.path.join(folders['llength'], 'g_postSac_nobinning'))
+    basal_letters[:, postSacP].astype(float).tofile(os.path.join(folders['llength'], 'basal_letters_postSac_nobinning'))
+    gating_letters[:, postSacP].astype(float).tofile(os.path.join(folders['llength'], 'gating_letters_postSac_nobinning'))
 
     if not _np.all(basal_letters[:,0]==gating_letters[:,0]):
         raise ValueError("""
@@ -314,12 +488,21 @@ def process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letter
     print('Digitizing linear prediction and responses')
     binning_type = 1     # 1: uses percentiles, 0: equidistant bins
     # bin g, basal and gating using percentiles defined during gating
-    percentiles = list(_np.arange(0, 100.1, 100/binsN))
-    bins = _np.percentile(noisy_g[:, int((.12-sim_start_t)/letter_length)], percentiles)
-    binned_g        = _np.digitize(noisy_g.flatten(), bins).reshape(noisy_g.shape)
-    bins = _np.percentile(gating_letters[:, int((.12-sim_start_t)/letter_length)], percentiles)
-    binned_basal    = _np.digitize(basal_letters.flatten(), bins).reshape(basal_letters.shape)
-    binned_gating    = _np.digitize(gating_letters.flatten(), bins).reshape(gating_letters.shape)
+    # binned arrays are uint8 (there are only binsN+2 symbols), bins are saved next to the results
+    gatingP = int((.12-sim_start_t)/letter_length)
+    g_binner = percentile_binner(binsN).fit(noisy_g, gatingP)
+    g_binner.save(os.path.join(folders['llength'], 'g_bins'))
+    binned_g        = g_binner.transform(noisy_g)
+    letters_binner = percentile_binner(binsN).fit(gating_letters, gatingP)
+    letters_binner.save(os.path.join(folders['llength'], 'letters_bins'))
+    binned_basal    = letters_binner.transform(basal_letters)
+    binned_gating   = letters_binner.transform(gating_letters)
+
+    if save_ranks:
+        # ranks are relative to the reference column (gatingP), saved as uint32 with the same shape as the letters
+        g_binner.ranks(noisy_g).astype(_np.uint32).tofile(os.path.join(folders['llength'], 'g_ranks'))
+        letters_binner.ranks(basal_letters).astype(_np.uint32).tofile(os.path.join(folders['llength'], 'basal_ranks'))
+        letters_binner.ranks(gating_letters).astype(_np.uint32).tofile(os.path.join(folders['llength'], 'gating_ranks'))
 
     if not _np.all(binned_basal[:,0] == binned_gating[:,0]):
         raise ValueError("""
@@ -327,44 +510,99 @@ def process(saccade_size, rw_step, bcell_nb, added_noise_factor, llength, letter
             """)
 
     # save just a few samples of g and letters for displaying purposes (only at -.1 and .1 secs) 
-    binned_g[:,preSacP].tofile(os.path.join(folders['llength'], 'binned_g_preSac'))
-    binned_basal[:,preSacP].tofile(os.path.join(folders['llength'], 'binned_basal_preSac'))
-    binned_gating[:,preSacP].tofile(os.path.join(folders['llength'], 'binned_gating_preSac'))
-    binned_g[:,postSacP].tofile(os.path.join(folders['llength'], 'binned_g_postSac'))
-    binned_basal[:,postSacP].tofile(os.path.join(folders['llength'], 'binned_basal_postSac'))
-    binned_gating[:,postSacP].tofile(os.path.join(folders['llength'], 'binned_gating_postSac'))
+    # (saved as int to keep the files as they were before binned arrays were uint8)
+    binned_g[:,preSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_g_preSac'))
+    binned_basal[:,preSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_basal_preSac'))
+    binned_gating[:,preSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_gating_preSac'))
+    binned_g[:,postSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_g_postSac'))
+    binned_basal[:,postSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_basal_postSac'))
+    binned_gating[:,postSacP].astype(int).tofile(os.path.join(folders['llength'], 'binned_gating_postSac'))
    
-    # From this point forward, I want data to be tuples. I will convert them here
-    # (doing it only once rather than doing it every time I need them).
-    # I'm actually converting the transverse because I want binned_g[i] to be all 'g' values at time point i
-    binned_g        = tuple(map(tuple, binned_g.T))
-    binned_basal    = tuple(map(tuple, binned_basal.T))
-    binned_gating   = tuple(map(tuple, binned_gating.T))
-
-
-    datapath = folders['letters']
+    # mi works on integer arrays where binned_g[i] is all 'g' values at time point i, hence the transpose
+    # (a view, nothing is copied)
+    binned_g        = binned_g.T
+    binned_basal    = binned_basal.T
+    binned_gating   = binned_gating.T
+
+
+    suffix = '' if mi_estimator == 'plugin' else '_' + mi_estimator
+    max_N = max(letters_N)
+    pntsN = len(binned_g)
+
+    def mi_files(k):
+        # same folder structure as make_datafolders
+        datapath = os.path.join(folders['llength'], "{0}Letters".format(k))
+        os.makedirs(os.path.join(datapath, 'Figures'), exist_ok=True)
+        return os.path.join(datapath, 'mi_{0}b_0g{1}'.format(k, suffix)), os.path.join(datapath, 'mi_0b_{0}g{1}'.format(k, suffix))
+
+    def missing(k, mi_file):
+        # outputs of the k letter information that are not on disk yet. Error bars and the null distribution
+        # are only computed for the word lengths in letters_N
+        todo = [] if os.path.isfile(mi_file) else ['mi']
+        # (replicates are evaluated from counts, the 'quadratic' estimator needs the samples and gets no error bars)
+        if k in letters_N and mi_error_bars is not None and mi_estimator != 'quadratic' and not os.path.isfile(mi_file + '_lower'):
+            todo.append('confidence')
+        if k in letters_N and mi_null_permutations > 0 and not os.path.isfile(mi_file + '_null95'):
+            todo.append('null')
+        return todo
+
+    labels = {'g':_as_codes(binned_g), 'basal':_as_codes(binned_basal), 'gating':_as_codes(binned_gating)}
+    # alphabet sizes come from the binners (binsN+2 symbols), not from the symbols observed
+    bases = {'g': g_binner.binsN + 2, 'basal': letters_binner.binsN + 2, 'gating': letters_binner.binsN + 2}
+    # the joint (g, letter) symbol at each time point has only bases['g']*bases[name] values, combining them
+    # before making words lets the joint words be packed like any other word (see _pack_words)
+    joint_labels = {name: _combine_codes(labels['g'], labels[name]) for name in ['basal', 'gating']}
+
+    # the jackknife leaves one image out at a time, if the image of each cell is known
+    image_ids_file = os.path.join(folders['FEM'], 'image_ids')
+    image_ids = _np.fromfile(image_ids_file, dtype=int) if os.path.isfile(image_ids_file) else None
+
+    todo = {k: {name: missing(k, mi_file) for name, mi_file in zip(['basal', 'gating'], mi_files(k))} for k in range(1, max_N+1)}
+
+    # words of every length are grown one letter at a time (see _grow_words), only up to the longest word with
+    # something left to compute. words[i] is the word ending at time point i+k-1, the words of each k are shared by the
+    # information, its error bars and its null distribution
+    last_N = max([k for k in todo if any(todo[k].values())] + [0])
+    growing = [_grow_words(l, last_N) for l in (labels['g'], labels['basal'], labels['gating'], joint_labels['basal'], joint_labels['gating'])]
+
+    for k, (g_words, basal_words, gating_words, basal_joint, gating_joint) in enumerate(zip(*growing), 1):
+        if not any(todo[k].values()):
+            print("Loading mi_{0}b_0g{1} and mi_0b_{0}g{1} from disk".format(k, suffix))
+            continue
 
-    mi_basal_file = os.path.join(datapath, 'mi_{0}b_0g'.format(letters_N))
-    if os.path.isfile(mi_basal_file):
-        print("Loading mi_{0}b_0g from disk".format(letters_N))
-        basal_discrete = _np.fromfile(mi_basal_file)
-    else:
-        print("Compute total information with {0} letters under basal NL".format(letters_N))
-        zeros = _np.zeros(letters_N-1)  # needed to keep basal_discrete and gating info of the same length and aligned in time
-        basal_discrete   = mi(combine_consecutive_labels(binned_g, letters_N), combine_consecutive_labels(binned_basal, letters_N))
-        basal_discrete = _np.concatenate((zeros, basal_discrete))
-        basal_discrete.tofile(mi_basal_file)
-
-    mi_gating_file = os.path.join(datapath, 'mi_0b_{0}g'.format(letters_N))
-    if os.path.isfile(mi_gating_file):
-        print("Loading mi_0b_{0}g from disk".format(letters_N))
-        gating_discrete = _np.fromfile(os.path.join(datapath, 'mi_0b_{0}g'.format(letters_N)))
-    else:
-        print("Compute total information with {0} letters under gating NL".format(letters_N))
-        zeros = _np.zeros(letters_N-1)  # needed to keep basal_discrete and gating info of the same length and aligned in time
-        gating_discrete   = mi(combine_consecutive_labels(binned_g, letters_N), combine_consecutive_labels(binned_gating, letters_N))
-        gating_discrete   = _np.concatenate((zeros, gating_discrete))
-        gating_discrete.tofile(mi_gating_file)
+        # g words' entropy is shared by the basal and gating information.
+        # Information is 0 for the first k-1 points, keeping basal_discrete and gating info aligned in time
+        zeros = _np.zeros(k-1)
+        g_entropy = None
+        words = {'basal': (basal_words, basal_joint), 'gating': (gating_words, gating_joint)}
+
+        for name, mi_file in zip(['basal', 'gating'], mi_files(k)):
+            letters_words, joint_words = words[name]
+
+            if 'mi' in todo[k][name]:
+                print("Compute total information with {0} letters under {1} NL".format(k, name))
+                if g_entropy is None:
+                    g_entropy = _entropy(g_words, estimator=mi_estimator, symbolsN=bases['g']**k)
+                info = _np.zeros(pntsN)
+                info[k-1:] = g_entropy + _entropy(letters_words, estimator=mi_estimator, symbolsN=bases[name]**k) \
+                        - _entropy(joint_words, estimator=mi_estimator, symbolsN=(bases['g']*bases[name])**k)
+                info.tofile(mi_file)
+
+            if 'confidence' in todo[k][name]:
+                print("Compute {0} confidence interval for {1}".format(mi_error_bars, os.path.basename(mi_file)))
+                lower, upper = mi_confidence(g_words, letters_words, method=mi_error_bars, groups=image_ids,
+                        estimator=mi_estimator, symbolsN=(bases['g']**k, bases[name]**k))
+                _np.concatenate((zeros, lower)).tofile(mi_file + '_lower')
+                _np.concatenate((zeros, upper)).tofile(mi_file + '_upper')
+
+            if 'null' in todo[k][name]:
+                print("Compute null distribution for {0}".format(os.path.basename(mi_file)))
+                pvalues, null = mi_null(g_words, letters_words, permutations=mi_null_permutations,
+                        estimator=mi_estimator, symbolsN=(bases['g']**k, bases[name]**k))
+                _np.concatenate((zeros, null[0])).tofile(mi_file + '_null95')
+
+    if last_N < max_N:
+        print("Loading mi_{{k}}b_0g{0} and mi_0b_{{k}}g{0} from disk for k = {1} to {2}".format(suffix, last_N+1, max_N))
 
 
 def cartoon_summary():
@@ -515,20 +753,379 @@ def _correlate_images(size):
         
     output.tofile( 'images_auto_corr')
     return output
+
+
+def _as_codes(labels):
+    '''
+    Convert labels into a 2d int64 ndarray of non negative codes, codes[i,j] is the symbol at time 'i' and trial 'j'
+
+    labels can be a 2d ndarray or a tuple of tuples (time x trials) or a 3d ndarray/tuple (time x trials x letters),
+    in which case the letters of each trial are combined into a single code
+    '''
+    labels = _np.asarray(labels)
+
+    if labels.ndim == 1:
+        labels = labels[_np.newaxis, :]
+
+    if labels.ndim == 3:
+        return _combine_codes(*[labels[..., k] for k in range(labels.shape[-1])])
+
+    if labels.ndim != 2:
+        raise ValueError('naturalscenes._as_codes: labels should be 2d (time x trials) or 3d (time x trials x letters)')
+
+    codes = labels.astype(_np.int64)
+    if codes.size and codes.min() < 0:
+        codes -= codes.min()
+
+    return codes
+
+
+def _combine_codes(*codes):
+    '''
+    Combine several (time x trials) arrays of labels into a single array of codes, such that two trials share
+    a code at a given time only if they share the label in all arrays.
+    '''
+    combined = _as_codes(codes[0])
+
+    for labels in codes[1:]:
+        labels = _as_codes(labels)
+        base = int(labels.max()) + 1 if labels.size else 1
+        if (int(combined.max()) + 1) * base > _np.iinfo(_np.int64).max:
+            # too many symbols to pack, replace them by their index among the symbols actually present
+            combined = _np.unique(combined, return_inverse=True)[1].reshape(combined.shape)
+            labels = _np.unique(labels, return_inverse=True)[1].reshape(labels.shape)
+            base = int(labels.max()) + 1
+
+        combined = combined * base + labels
+
+    return combined
+
+
+def _symbol_counts(block, backend='auto', max_counts=2**24):
+    '''
+    Count how many times each symbol appears in each row of block (2d int64 codes, time x samples)
+
+    inputs:
+    -------
+        backend:    'dense', counts with a single bincount over code + row*symbolsN. Memory scales with
+                    the alphabet size (block.max()+1) times the number of rows.
+                    If even the symbols present in the block do not fit in max_counts, 'sort' is used.
+                    'sort', sorts each row and counts runs of equal codes. Memory scales with the number
+                    of samples, regardless of the alphabet size (needed for long words, binsN**letters_N symbols)
+                    'auto', 'dense' if the table of counts has no more than max_counts elements, 'sort' otherwise
+
+    output:
+    -------
+        rows:       1d int array, row of each observed (row, symbol) pair
+
+        counts:     1d int array, number of samples with that symbol in that row
+    '''
+    rowsN, samples = block.shape
+    symbolsN = int(block.max()) + 1 if block.size else 1
+
+    if backend == 'auto':
+        backend = 'dense' if symbolsN * rowsN <= max_counts else 'sort'
+
+    if backend == 'dense' and symbolsN * rowsN > max_counts:
+        # replace symbols by their index among the symbols present in the block. If the table of counts is still
+        # larger than max_counts (long words, most symbols seen only once) count by sorting instead
+        uniques, inverse = _np.unique(block, return_inverse=True)
+        if len(uniques) * rowsN > max_counts:
+            backend = 'sort'
+        else:
+            block = inverse.reshape(block.shape)
+            symbolsN = len(uniques)
+
+    if backend == 'dense':
+        offsets = _np.arange(rowsN, dtype=_np.int64)[:, _np.newaxis] * symbolsN
+        counts = _np.bincount((block + offsets).ravel(), minlength=rowsN*symbolsN)
+        observed = _np.flatnonzero(counts)
+        return observed // symbolsN, counts[observed]
+
+    if backend == 'sort':
+        sorted_block = _np.sort(block, axis=1)
+        # a run starts at the beginning of every row and whenever the code changes within a row
+        new_run = _np.ones(sorted_block.shape, dtype=bool)
+        new_run[:, 1:] = sorted_block[:, 1:] != sorted_block[:, :-1]
+        starts = _np.flatnonzero(new_run)
+        counts = _np.diff(_np.append(starts, sorted_block.size))
+        return starts // samples, counts
+
+    raise ValueError("naturalscenes._symbol_counts: backend should be 'auto', 'dense' or 'sort', got {0}".format(backend))
+
+
+def _entropy(codes, backend='auto', max_counts=2**24, estimator='plugin', symbolsN=None):
+    '''
+    Entropy (in bits) of each row of codes (output of _as_codes), one value per time point
+
+    inputs:
+    -------
+        backend:        passed to _symbol_counts
+
+        estimator:      'plugin', entropy of the observed frequencies
+                        'miller_madow', plugin + (observed symbols - 1)/(2 n ln2)
+                        'panzeri_treves', plugin + (relevant symbols - 1)/(2 n ln2), with the number of relevant
+                            symbols estimated from the counts (see _pt_relevant_symbols)
+                        'quadratic', extrapolation to infinite samples of the plugin entropies computed on
+                            1, 1/2 and 1/4 of the samples (Strong et al. 1998)
+                        'nsb', Nemenman-Shafee-Bialek estimator (see _nsb_entropy)
+
+        symbolsN:       size of the alphabet, only used by 'panzeri_treves' and 'nsb'. Defaults to codes.max()+1, which
+                        underestimates it whenever the largest symbol is not observed or codes were re-indexed
+                        (see _combine_codes). Pass the true size (for example binsN+2 per binned letter) with those estimators
+
+    Implementation notes:
+        Counts for all time points are computed at once (see _symbol_counts for the backends).
+        Rows are processed in blocks of at most max_counts samples.
+    '''
+    rows, samples = codes.shape
+    entropy = _np.zeros(rows)
+    if rows == 0 or samples == 0:
+        return entropy
+
+    if symbolsN is None:
+        symbolsN = int(codes.max()) + 1
+
+    if estimator == 'quadratic':
+        # H(N) = H_inf + a/N + b/N**2, fitted (exactly) to N = n, n/2 and n/4. The coefficients are the
+        # Lagrange weights for extrapolating to 1/N = 0. The same (fixed) partition of the samples is used for
+        # every call, such that H(x), H(y) and H(x,y) are computed on the same subsets.
+        # The weights assume subsets of exactly n/2 and n/4 samples, the samples%4 samples left over are dropped
+        order = _np.random.RandomState(0).permutation(samples)[:samples - samples % 4]
+        for parts, weight in zip((1, 2, 4), (8/3, -2, 1/3)):
+            subsets = [_entropy(codes[:, subset], backend, max_counts) for subset in _np.array_split(order, parts)]
+            entropy += weight * _np.mean(subsets, axis=0)
+        return entropy
+
+    rows_per_block = max(1, max_counts // samples)
+
+    for start in range(0, rows, rows_per_block):
+        block = codes[start:start+rows_per_block]
+        count_rows, counts = _symbol_counts(block, backend, max_counts)
+        entropy[start:start+block.shape[0]] = _entropy_from_counts(count_rows, counts, block.shape[0], samples, estimator, symbolsN)
+
+    return entropy
+
+
+def _entropy_from_counts(count_rows, counts, rowsN, samples, estimator, symbolsN):
+    '''
+    Entropy (in bits) of each row given the output of _symbol_counts, see _entropy for the estimators.
+    samples is either the number of samples of every row or a 1d array with the number of samples in each row
+    '''
+    # H = log2(n) - sum(c*log2(c))/n
+    clogc = _np.bincount(count_rows, weights=counts*_np.log2(counts), minlength=rowsN)
+    plugin = _np.log2(samples) - clogc/samples
+
+    if estimator == 'plugin':
+        return plugin
+
+    if estimator == 'miller_madow':
+        observed = _np.bincount(count_rows, minlength=rowsN)
+        return plugin + (observed - 1)/(2*samples*_np.log(2))
+
+    # count_rows is sorted, split counts into one array per row
+    row_counts = _np.split(counts, _np.searchsorted(count_rows, _np.arange(1, rowsN)))
+
+    row_samples = _np.broadcast_to(samples, (rowsN,))
+
+    if estimator == 'panzeri_treves':
+        relevant = _np.array([_pt_relevant_symbols(c, n, symbolsN) for c, n in zip(row_counts, row_samples)])
+        return plugin + (relevant - 1)/(2*samples*_np.log(2))
+
+    if estimator == 'nsb':
+        return _np.array([_nsb_entropy(c, n, symbolsN) for c, n in zip(row_counts, row_samples)])
+
+    raise ValueError("naturalscenes._entropy: estimator should be one of 'plugin', 'miller_madow', 'panzeri_treves', 'quadratic' or 'nsb', got {0}".format(estimator))
+
+
+def _pt_relevant_symbols(counts, samples, symbolsN):
+    '''
+    Estimate the number of symbols with non negligible probability from the counts of the observed symbols,
+    as in Panzeri & Treves 1996 (bayesian counting)
+
+    Implementation notes:
+        The probability of all unobserved symbols is estimated as the fraction of symbols observed once (Good-Turing).
+        For R relevant symbols, observed ones keep their (rescaled) frequencies and the R - m unobserved ones share
+        the missing probability. R is the smallest number such that the expected number of observed symbols in
+        'samples' draws reaches the number actually observed (m). R is never larger than symbolsN or m + samples
+    '''
+    observed = len(counts)
+    missing = (counts == 1).sum()/samples
+    max_relevant = int(min(symbolsN, observed + samples))
+
+    if missing == 0 or max_relevant <= observed:
+        return observed
+
+    seen = (1 - (1 - (1-missing)*counts/samples)**samples).sum()
+
+    def expected(relevant):
+        unseen = relevant - observed
+        return seen + unseen * (1 - (1 - missing/unseen)**samples)
+
+    # expected grows with the number of relevant symbols, bisect
+    low, high = observed + 1, max_relevant
+    if expected(high) < observed:
+        return high
+
+    while low < high:
+        middle = (low + high)//2
+        if expected(middle) >= observed:
+            high = middle
+        else:
+            low = middle + 1
+
+    return low
+
+
+def _nsb_entropy(counts, samples, symbolsN, betasN=2000):
+    '''
+    Nemenman-Shafee-Bialek entropy estimate (in bits) from the counts of the observed symbols and the alphabet size
+
+    Implementation notes:
+        Dirichlet priors with concentration beta are mixed such that the prior on the entropy is uniform,
+        p(beta) ~ d xi/d beta, xi(beta) = psi(K*beta+1) - psi(beta+1) the expected entropy under the Dirichlet prior.
+        The posterior mean entropy is integrated numerically over a log spaced grid of betas. Unobserved symbols
+        enter the likelihood and the conditional mean entropy analytically (K - m identical terms), such that the
+        cost depends on the number of distinct counts rather than on the alphabet size.
+    '''
+    from scipy.special import gammaln, digamma, polygamma
+
+    K = float(symbolsN)
+    n = float(samples)
+    observed = len(counts)
+    values, multiplicity = _np.unique(counts, return_counts=True)
+    values = values[:, _np.newaxis].astype(float)
+    multiplicity = multiplicity[:, _np.newaxis]
+
+    log_beta = _np.linspace(_np.log(1e-4/K), _np.log(1e4), betasN)
+    beta = _np.exp(log_beta)
+
+    log_likelihood = gammaln(K*beta) - gammaln(n + K*beta) + (multiplicity*(gammaln(values + beta) - gammaln(beta))).sum(axis=0)
+
+    # d xi/d beta, times beta because the integral is over log(beta)
+    prior = beta*(K*polygamma(1, K*beta + 1) - polygamma(1, beta + 1))
+    prior = _np.maximum(prior, 0)
+
+    mean_entropy = digamma(n + K*beta + 1) \
+            - (multiplicity*(values + beta)*digamma(values + beta + 1)).sum(axis=0)/(n + K*beta) \
+            - (K - observed)*beta*digamma(beta + 1)/(n + K*beta)
+
+    weights = prior*_np.exp(log_likelihood - log_likelihood.max())
+
+    # log_beta is evenly spaced, the integrals' spacing cancels in the ratio
+    return (weights*mean_entropy).sum()/weights.sum()/_np.log(2)
+
+
+def _pack_words(labels, N):
+    '''
+    Encode the N consecutive labels ending at each time point as a single int64 per trial
+
+    inputs:
+    -------
+        labels:     2d ndarray of non negative ints, labels[i,j] is the label at time 'i' and trial 'j'
+
+        N:          number of letters per word
+
+    output:
+    -------
+        words:      2d int64 ndarray with shape (labels.shape[0]-N+1, labels.shape[1]), words[i] is the word
+                    ending at time point i+N-1 (aligned with labels[N-1:])
+
+    Implementation notes:
+        With base = labels.max()+1, word(t) = sum_k labels[t-k] * base**k (newest letter is the least significant).
+        Words are updated in place from one time point to the next, word(t) = (word(t-1) % base**(N-1)) * base + labels[t],
+        so the whole array takes O(time * trials) integer operations.
+        If base**N does not fit in an int64, words are replaced by their value (the same base**k expansion) modulo
+        two primes p1, p2 close to 2**31, computed with a rolling update. The two residues are packed into one int64,
+        which amounts to the word's value modulo p1*p2 (~2**62). This is deterministic, not a random hash: two different
+        words share a code only if their values are congruent modulo p1*p2, which can not be ruled out in general.
+        Labels and base are reduced modulo each prime before multiplying, such that no product exceeds 2**62.
+    '''
+    labels = _as_codes(labels)
+    pntsN, trialsN = labels.shape
+    words = _np.empty((max(pntsN-N+1, 0), trialsN), dtype=_np.int64)
+    base = int(labels.max()) + 1 if labels.size else 1
+
+    if base**N <= _np.iinfo(_np.int64).max:
+        top = base**(N-1)
+        word = _np.zeros(trialsN, dtype=_np.int64)
+        for t in range(pntsN):
+            _np.remainder(word, top, out=word)
+            word *= base
+            word += labels[t]
+            if t >= N-1:
+                words[t-N+1] = word
+        return words
+
+    primes = (2147483647, 2147483629)
+    hashes = _np.zeros((2, trialsN), dtype=_np.int64)
+    for t in range(pntsN):
+        for h, p in zip(hashes, primes):
+            # every factor is below p < 2**31, products fit in an int64
+            if t >= N:
+                # remove the oldest letter, its weight is base**(N-1)
+                h -= (labels[t-N] % p) * pow(base, N-1, p)
+                _np.remainder(h, p, out=h)
+            h *= base % p
+            h += labels[t] % p
+            _np.remainder(h, p, out=h)
+        if t >= N-1:
+            words[t-N+1] = hashes[0] * primes[1] + hashes[1]
+
+    return words
+
+
+def _grow_words(labels, max_N):
+    '''
+    Generator yielding _pack_words(labels, k) for k = 1, ..., max_N (same codes), each one made by extending the
+    words of the previous k by their oldest letter rather than packing them from scratch
+
+    Implementation notes:
+        words_k[i] = words_(k-1)[i+1] + labels[i] * base**(k-1), O(time * trials) integer operations per k.
+        Once base**k does not fit in an int64 words are kept as their residues modulo the two primes of _pack_words
+        and extended the same way (labels and base**(k-1) reduced modulo each prime), such that the codes are the
+        same as _pack_words' fallback.
+    '''
+    labels = _as_codes(labels)
+    pntsN = len(labels)
+    base = int(labels.max()) + 1 if labels.size else 1
+    primes = (2147483647, 2147483629)
+
+    words = labels
+    residues = None
+    for k in range(1, max_N+1):
+        if k > 1:
+            oldest = labels[:pntsN-k+1]
+            if residues is None and base**k <= _np.iinfo(_np.int64).max:
+                words = words[1:] + oldest * base**(k-1)
+            else:
+                if residues is None:
+                    residues = [words % p for p in primes]
+                residues = [(r[1:] + (oldest % p) * pow(base, k-1, p)) % p for r, p in zip(residues, primes)]
+                words = residues[0] * primes[1] + residues[1]
+
+        yield words
+
+
 def combine_consecutive_labels(labels, N):
     '''
     labels is a tuple of tuple such that labels[i][j] holds the label at time 'i' and trial 'j'
     Concatenate N consecutive labels to form a word (either in stimulus or response)
+
+    If labels is an ndarray, each word is packed into a single int64 (see _pack_words) and the output
+    is a 2d int64 ndarray (time x trials) rather than a tuple
     '''
 
     # if N == 1 maybe I shouldn't be calling this function but I include the flag here so that I don't have to worry about it when within loops
     if N==1:
         return labels
 
+    if isinstance(labels, _np.ndarray):
+        return _pack_words(labels, N)
+
     labels_to_pass = _np.dstack((labels[N-1:],labels[N-2:-1]))
     for i in range(2, N):
         labels_to_pass = _np.dstack((labels_to_pass, labels[(N-i-1):-i]))
-
     
     return tuple(map(lambda x: tuple(map(tuple, x)), labels_to_pass))
 
@@ -540,36 +1137,559 @@ def combine_labels(*labels):
         labels[0] refers to basal_letters[1:]
         labels[1] refers to basal_letters[:-1]
 
+    If all labels are ndarrays the output is a 3d ndarray rather than a tuple
     '''
+    as_array = all(isinstance(l, _np.ndarray) for l in labels)
     labels = _np.dstack(labels)
+
+    if as_array:
+        return labels
+
     return tuple(map(lambda x: tuple(map(tuple, x)), labels))
 
-def cond_mi(x, y, z):
+def _rows_worker(func, specs, start, end, kwargs):
+    '''
+    Executed in a worker process of _parallel_rows: attach to the shared memory blocks described in specs
+    (name, shape, dtype) and evaluate func on rows start:end of every array
+    '''
+    blocks = [_shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    arrays = []
+    try:
+        arrays = [_np.ndarray(shape, dtype=dtype, buffer=block.buf)[start:end] for block, (_, shape, dtype) in zip(blocks, specs)]
+        return func(*arrays, **kwargs)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+def _parallel_rows(func, arrays, n_jobs, **kwargs):
+    '''
+    Evaluate func(*arrays, **kwargs) in a pool of n_jobs processes, each one working on a chunk of
+    time points (rows). arrays are copied once into shared memory and the results are concatenated in order.
+
+    n_jobs = -1 uses all cores
+    '''
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    rows = len(arrays[0])
+    edges = _np.linspace(0, rows, min(n_jobs, rows) + 1).astype(int)
+
+    blocks = []
+    try:
+        specs = []
+        for array in arrays:
+            block = _shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            _np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs.append((block.name, array.shape, array.dtype.str))
+
+        with _ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_rows_worker, func, specs, start, end, kwargs) for start, end in zip(edges[:-1], edges[1:])]
+            return _np.concatenate([future.result() for future in futures])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def cond_mi(x, y, z, backend='auto', n_jobs=1, estimator='plugin', symbolsN=None):
     '''
     for each time point (axis 0) of x,y,z, compute MI(x[i], y[i] | z[i])
+
+    x, y, z are 2d int ndarrays (or tuples of tuples) such that x[i][j] represents sample j at time point i.
+    3d inputs (time x samples x letters, see combine_labels) are treated as words.
+    backend is passed to _symbol_counts, the default picks the sort based counts for large alphabets (long words)
+    n_jobs > 1 splits the time points among that many processes (-1 uses all cores), see _parallel_rows
+    estimator is the entropy estimator (see _entropy), symbolsN the alphabet sizes of x, y and z (defaults to max+1 of each,
+    'panzeri_treves' and 'nsb' need the true sizes, see _entropy)
+
+    Implementation notes:
+        I(x;y|z) = H(x,z) + H(y,z) - H(x,y,z) - H(z), with all entropies computed for every time point at once (see _entropy)
     '''
-    #_ipdb.set_trace()
-    time_pnts = len(x)
-    info = _np.zeros(time_pnts)
+    x = _as_codes(x)
+    y = _as_codes(y)
+    z = _as_codes(z)
 
-    for i in range(time_pnts):
-        info[i] = _discrete.cond_mi(x[i], y[i], z[i])
+    if symbolsN is None:
+        symbolsN = tuple(int(c.max()) + 1 for c in (x, y, z))
 
-    return info
+    if n_jobs != 1 and len(x) > 1:
+        return _parallel_rows(cond_mi, (x, y, z), n_jobs, backend=backend, estimator=estimator, symbolsN=symbolsN)
 
+    Kx, Ky, Kz = symbolsN
+    xz = _combine_codes(x, z)
+    yz = _combine_codes(y, z)
+    xyz = _combine_codes(xz, y)
 
-def mi(x, y):
-    #_ipdb.set_trace()
+    return _entropy(xz, backend, estimator=estimator, symbolsN=Kx*Kz) + _entropy(yz, backend, estimator=estimator, symbolsN=Ky*Kz) \
+            - _entropy(xyz, backend, estimator=estimator, symbolsN=Kx*Ky*Kz) - _entropy(z, backend, estimator=estimator, symbolsN=Kz)
+
+
+def mi(x, y, backend='auto', n_jobs=1, estimator='plugin', symbolsN=None):
+    '''
+    for each time point (axis 0) of x,y, compute MI(x[i], y[i])
+
+    x, y are 2d int ndarrays (or tuples of tuples) such that x[i][j] represents sample j at time point i.
+    3d inputs (time x samples x letters, see combine_consecutive_labels) are treated as words.
+    backend is passed to _symbol_counts, the default picks the sort based counts for large alphabets (long words)
+    n_jobs > 1 splits the time points among that many processes (-1 uses all cores), see _parallel_rows
+    estimator is the entropy estimator (see _entropy), symbolsN the alphabet sizes of x and y (defaults to max+1 of each,
+    'panzeri_treves' and 'nsb' need the true sizes, see _entropy)
+
+    Implementation notes:
+        I(x;y) = H(x) + H(y) - H(x,y), with all entropies computed for every time point at once (see _entropy)
+    '''
+    x = _as_codes(x)
+    y = _as_codes(y)
+
+    if symbolsN is None:
+        symbolsN = tuple(int(c.max()) + 1 for c in (x, y))
+
+    if n_jobs != 1 and len(x) > 1:
+        return _parallel_rows(mi, (x, y), n_jobs, backend=backend, estimator=estimator, symbolsN=symbolsN)
+
+    Kx, Ky = symbolsN
+
+    return _entropy(x, backend, estimator=estimator, symbolsN=Kx) + _entropy(y, backend, estimator=estimator, symbolsN=Ky) \
+            - _entropy(_combine_codes(x, y), backend, estimator=estimator, symbolsN=Kx*Ky)
+
+def _row_inverse(codes):
+    '''
+    For each row of codes (output of _as_codes), replace every symbol by its index among the symbols present in
+    that row
+
+    output:
+    -------
+        inverse:    2d int ndarray, same shape as codes, values in range(symbolsN[i]) for row i
+
+        symbolsN:   1d int ndarray, number of distinct symbols in each row
+    '''
+    order = _np.argsort(codes, axis=1, kind='stable')
+    sorted_codes = _np.take_along_axis(codes, order, axis=1)
+
+    new_symbol = _np.ones(codes.shape, dtype=bool)
+    new_symbol[:, 1:] = sorted_codes[:, 1:] != sorted_codes[:, :-1]
+    ids = _np.cumsum(new_symbol, axis=1) - 1
 
-    # x/y are tuples of tuples, such that x[i][j] represents sample j at time point i
-    time_pnts = len(x)
-    info = _np.zeros(time_pnts)
+    inverse = _np.empty_like(ids)
+    _np.put_along_axis(inverse, order, ids, axis=1)
 
-    for i in range(time_pnts):
-        info[i] = _discrete.mi(x[i], y[i])
+    return inverse, ids[:, -1] + 1
+
+
+def _combine_row_inverses(*inverses):
+    '''
+    Combine several outputs of _row_inverse (inverse, symbolsN) into the (inverse, symbolsN) of the joint symbol.
+    Codes are packed two at a time and re-indexed within each row, so they never exceed samples**2 (no overflow,
+    regardless of the size of the original alphabets)
+    '''
+    inverse, symbolsN = inverses[0]
+
+    for other, otherN in inverses[1:]:
+        inverse, symbolsN = _row_inverse(inverse * otherN[:, _np.newaxis] + other)
+
+    return inverse, symbolsN
+
+
+def _jackknife_entropy(inverse, symbolsN, groups, estimator='plugin', alphabetN=None):
+    '''
+    Entropy (in bits) of each row when leaving out each group of samples
+
+    inputs:
+    -------
+        inverse, symbolsN:  output of _row_inverse (or _combine_row_inverses)
+
+        groups:             1d int array with the group (image) of each sample, replicate i leaves group i out
+
+        estimator:          'plugin', 'miller_madow', 'panzeri_treves' or 'nsb' (see _entropy)
+
+        alphabetN:          size of the alphabet, only used by 'panzeri_treves' and 'nsb'
+
+    output:
+    -------
+        entropy:            2d ndarray, entropy[i, t] is the entropy at time point t without the samples in group i
+
+    Implementation notes:
+        sum(c*log2(c)) is computed once from the total counts. Leaving a group out only changes the counts of the
+        symbols that group contains, the (group, symbol) pairs actually present and their counts come out of a
+        single sort of group*symbolsN + symbol, and each group's sum is corrected for those pairs only.
+        This is O(samples) memory per row, regardless of the number of groups and symbols.
+        'miller_madow' corrects the number of observed symbols the same way. 'panzeri_treves' and 'nsb' need the
+        whole count vector of each replicate, it is rebuilt from the total counts for one group at a time
+        (O(symbols) memory, O(groups * symbols) time per row).
+    '''
+    if estimator not in ['plugin', 'miller_madow', 'panzeri_treves', 'nsb']:
+        raise ValueError("naturalscenes._jackknife_entropy: estimator should be one of 'plugin', 'miller_madow', 'panzeri_treves' or 'nsb', got {0}".format(estimator))
+
+    rows, samples = inverse.shape
+    groupsN = int(groups.max()) + 1
+    sizes = samples - _np.bincount(groups, minlength=groupsN)
+
+    entropy = _np.zeros((groupsN, rows))
+
+    for t in range(rows):
+        m = symbolsN[t]
+        counts = _np.bincount(inverse[t], minlength=m)
+        pairs, group_counts = _np.unique(groups*m + inverse[t], return_counts=True)
+        pair_groups, pair_symbols = pairs // m, pairs % m
+        total = counts[pair_symbols]
+
+        if estimator in ['plugin', 'miller_madow']:
+            delta = _xlog2x(total) - _xlog2x(total - group_counts)
+            clogc = _xlog2x(counts).sum() - _np.bincount(pair_groups, weights=delta, minlength=groupsN)
+            entropy[:, t] = _np.log2(sizes) - clogc/sizes
+
+            if estimator == 'miller_madow':
+                # symbols only present in the left out group are no longer observed
+                observed = m - _np.bincount(pair_groups, weights=total == group_counts, minlength=groupsN)
+                entropy[:, t] += (observed - 1)/(2*sizes*_np.log(2))
+            continue
+
+        # pairs are sorted by group, the pairs of group i are pairs[starts[i]:starts[i+1]]
+        starts = _np.searchsorted(pair_groups, _np.arange(groupsN + 1))
+        for i in range(groupsN):
+            left = counts.copy()
+            left[pair_symbols[starts[i]:starts[i+1]]] -= group_counts[starts[i]:starts[i+1]]
+            left = left[left > 0]
+            entropy[i, t] = _entropy_from_counts(_np.zeros(len(left), dtype=int), left, 1, sizes[i], estimator, alphabetN)[0]
+
+    return entropy
+
+
+def _xlog2x(counts):
+    '''
+    counts * log2(counts) elementwise, with 0 log 0 = 0
+    '''
+    counts = _np.asarray(counts, dtype=float)
+    out = _np.zeros(counts.shape)
+    nonzero = counts > 0
+    out[nonzero] = counts[nonzero] * _np.log2(counts[nonzero])
+    return out
+
+
+def resampled_mi(x, y, z=None, method='bootstrap', replicates=100, groups=None, seed=0, estimator='plugin', symbolsN=None):
+    '''
+    Bootstrap or jackknife replicates of mi(x, y) (or cond_mi(x, y, z) if z is given) for every time point,
+    computed from the integer codes without recomputing the symbols
+
+    inputs:
+    -------
+        x, y, z:        as in mi and cond_mi
+
+        method:         'bootstrap', samples are drawn with replacement (multinomial over the observed joint symbols)
+                        'jackknife', leave one group of samples out at a time
+
+        replicates:     number of bootstrap replicates. For the jackknife it is the number of contiguous blocks
+                        of samples used as groups when 'groups' is not given
+
+        groups:         1d int array, group of each sample for the jackknife, typically the image each
+                        cell was simulated on (see cell.processAllImages, 'image_ids')
+
+        seed:           seed for the bootstrap draws
+
+        estimator:      entropy estimator applied to the counts of every replicate, 'plugin', 'miller_madow',
+                        'panzeri_treves' or 'nsb' (see _entropy). 'quadratic' needs the samples themselves and
+                        is not available here
+
+        symbolsN:       alphabet sizes of x, y (and z) as in mi and cond_mi, only used by 'panzeri_treves' and 'nsb'
+
+    output:
+    -------
+        info:           2d ndarray, info[r, t] is the information of replicate r at time point t
+
+    Implementation notes:
+        Symbols of x, y, z and of the joint symbols entering each entropy are re-indexed within each row once
+        (_row_inverse, _combine_row_inverses).
+        Bootstrap: at time point t, a replicate only depends on how many times each observed joint symbol (cell)
+        is drawn, so counts are drawn directly as multinomial(samples, cell_counts/samples) for all replicates
+        at once and the counts of x, y (xz, yz, z) are obtained by adding up the cells mapping to each of
+        their symbols. Memory and time per time point are O(replicates * cells), cells being the number of
+        distinct joint symbols observed at that time point (<= samples, much less for short words), rather than
+        O(replicates * samples) per entropy. Replicates are drawn independently at every time point.
+        Jackknife: see _jackknife_entropy
+    '''
+    if estimator not in ['plugin', 'miller_madow', 'panzeri_treves', 'nsb']:
+        raise ValueError("naturalscenes.resampled_mi: estimator should be one of 'plugin', 'miller_madow', 'panzeri_treves' or 'nsb', got {0}".format(estimator))
+
+    variables = [_as_codes(x), _as_codes(y)]
+    if z is not None:
+        variables.append(_as_codes(z))
+    rows, samples = variables[0].shape
+
+    if symbolsN is None:
+        symbolsN = tuple(int(v.max()) + 1 for v in variables)
+
+    # each term of the information is (sign, indices into variables)
+    if z is None:
+        terms = [(1, (0,)), (1, (1,)), (-1, (0, 1))]
+    else:
+        terms = [(1, (0, 2)), (1, (1, 2)), (-1, (0, 1, 2)), (-1, (2,))]
+
+    inverses = [_row_inverse(v) for v in variables]
+    compact = [_combine_row_inverses(*[inverses[i] for i in indices]) for _, indices in terms]
+    alphabets = [int(_np.prod([float(symbolsN[i]) for i in indices])) for _, indices in terms]
+
+    if method == 'jackknife':
+        if groups is None:
+            groups = _np.arange(samples)*replicates//samples
+        # re-index groups such that there are no empty ones
+        groups = _np.unique(groups, return_inverse=True)[1].reshape(-1)
+        return sum(sign * _jackknife_entropy(inverse, distinct, groups, estimator, alphabetN)
+                for (sign, _), (inverse, distinct), alphabetN in zip(terms, compact, alphabets))
+
+    if method != 'bootstrap':
+        raise ValueError("naturalscenes.resampled_mi: method should be 'bootstrap' or 'jackknife', got {0}".format(method))
+
+    rng = _np.random.RandomState(seed)
+    offsets = _np.arange(replicates)[:, _np.newaxis]
+    # the joint symbol of all variables is the term with all indices
+    cells, cellsN = compact[[len(indices) for _, indices in terms].index(len(variables))]
+
+    info = _np.zeros((replicates, rows))
+    for t in range(rows):
+        cell_counts = _np.bincount(cells[t], minlength=cellsN[t])
+        weights = rng.multinomial(samples, cell_counts/samples, size=replicates)
+
+        # one sample of each cell, to read the symbol of every variable in that cell
+        representative = _np.empty(cellsN[t], dtype=int)
+        representative[cells[t]] = _np.arange(samples)
+
+        for (sign, _), (inverse, distinct), alphabetN in zip(terms, compact, alphabets):
+            m = distinct[t]
+            counts = _np.bincount((offsets*m + inverse[t][representative]).ravel(), weights=weights.ravel(), minlength=replicates*m)
+            counts = _np.rint(counts).astype(_np.int64).reshape(replicates, m)
+            if estimator == 'plugin':
+                info[:, t] += sign * (_np.log2(samples) - _xlog2x(counts).sum(axis=1)/samples)
+            else:
+                count_rows, count_symbols = _np.nonzero(counts)
+                info[:, t] += sign * _entropy_from_counts(count_rows, counts[count_rows, count_symbols], replicates, samples, estimator, alphabetN)
 
     return info
 
+
+def mi_confidence(x, y, z=None, method='bootstrap', replicates=100, groups=None, alpha=.05, seed=0, estimator='plugin', symbolsN=None):
+    '''
+    Confidence interval of mi(x, y) (or cond_mi(x, y, z)) at every time point, see resampled_mi.
+    estimator and symbolsN are applied to every replicate and to the jackknife's central estimate
+
+    output:
+    -------
+        lower, upper:   1d ndarrays, limits of the (1-alpha) confidence interval.
+                        Bootstrap intervals are percentiles of the replicates, jackknife ones are
+                        MI -/+ the normal quantile times the jackknife standard error.
+                        Replicates carry the estimator's own sampling bias on top of the estimate's, with few samples
+                        per symbol (long words) bootstrap percentiles can lie entirely above the estimate
+    '''
+    info = resampled_mi(x, y, z, method, replicates, groups, seed, estimator, symbolsN)
+
+    if method == 'bootstrap':
+        lower, upper = _np.percentile(info, [100*alpha/2, 100*(1-alpha/2)], axis=0)
+        return lower, upper
+
+    from scipy.stats import norm
+
+    groupsN = info.shape[0]
+    estimate = mi(x, y, estimator=estimator, symbolsN=symbolsN) if z is None else cond_mi(x, y, z, estimator=estimator, symbolsN=symbolsN)
+    sem = _np.sqrt((groupsN-1)/groupsN * ((info - info.mean(axis=0))**2).sum(axis=0))
+    return estimate - norm.ppf(1-alpha/2)*sem, estimate + norm.ppf(1-alpha/2)*sem
+
+
+def mi_null(x, y, permutations=1000, quantiles=(.95,), alpha=.05, batch=100, early_stop=True, seed=0, estimator='plugin', symbolsN=None):
+    '''
+    Permutation test for mi(x, y) at every time point. y is shuffled across samples, breaking its relation
+    with x, and the MI of the shuffled data builds the null distribution.
+
+    inputs:
+    -------
+        x, y:           as in mi
+
+        permutations:   maximum number of permutations per time point
+
+        quantiles:      quantiles of the null distribution to return (0.95 is the 5% significance threshold)
+
+        alpha:          significance level used for early stopping
+
+        batch:          number of permutations evaluated at once
+
+        early_stop:     if True, a time point stops receiving permutations once its outcome is decided, either
+                        because it can no longer be significant at alpha or because it will be significant
+                        even if all remaining permutations exceed the observed MI. Null quantiles of
+                        those time points come from the permutations done until then.
+
+        seed:           seed for the permutations
+
+        estimator:      entropy estimator used for the observed and for every shuffled MI (see _entropy), such that
+                        the null is comparable with information curves computed with that estimator
+
+        symbolsN:       alphabet sizes of x and y as in mi, only used by 'panzeri_treves' and 'nsb'
+
+    output:
+    -------
+        pvalues:        1d ndarray, (1 + # null >= observed)/(1 + # permutations) at every time point
+
+        null:           2d ndarray, null[i, t] is quantiles[i] of the null distribution at time point t
+
+    Implementation notes:
+        H(x) and H(y) do not change when y is shuffled, only H(x, y) has to be computed for every permutation
+        (and H(y) with the 'quadratic' estimator, whose subsets are fixed sample positions).
+        Each batch is a (batch x samples) array of indices shared by all time points, the joint codes of all
+        permutations in a batch are counted at once (see _entropy).
+        x and y are re-indexed within each row (_row_inverse) before combining them, such that joint codes are
+        below samples**2 even for long words. The observed MI is computed from the same joint codes.
+    '''
+    x = _as_codes(x)
+    y = _as_codes(y)
+    if symbolsN is None:
+        symbolsN = tuple(int(c.max()) + 1 for c in (x, y))
+    Kx, Ky = symbolsN
+
+    x = _row_inverse(x)[0]
+    y, y_symbolsN = _row_inverse(y)
+    pntsN, samples = x.shape
+    rng = _np.random.RandomState(seed)
+
+    y_entropy = _entropy(y, estimator=estimator, symbolsN=Ky)
+    marginals = _entropy(x, estimator=estimator, symbolsN=Kx) + y_entropy
+    x_offset = x * y_symbolsN[:, _np.newaxis]
+    observed = marginals - _entropy(x_offset + y, estimator=estimator, symbolsN=Kx*Ky)
+
+    null = [[] for t in range(pntsN)]
+    exceed = _np.zeros(pntsN, dtype=int)
+    done = _np.zeros(pntsN, dtype=int)
+    active = _np.ones(pntsN, dtype=bool)
+
+    for start in range(0, permutations, batch):
+        if not active.any():
+            break
+
+        size = min(batch, permutations - start)
+        indices = _np.argsort(rng.random_sample((size, samples)), axis=1)
+
+        for t in _np.flatnonzero(active):
+            joint = x_offset[t] + y[t][indices]
+            shuffled = marginals[t] - _entropy(joint, estimator=estimator, symbolsN=Kx*Ky)
+            if estimator == 'quadratic':
+                # the subsets of the extrapolation are fixed positions, H(y) changes when y is shuffled
+                shuffled += _entropy(y[t][indices], estimator=estimator) - y_entropy[t]
+            null[t].append(shuffled)
+            # tolerance such that permutations that reproduce the observed MI count as exceeding it
+            exceed[t] += (shuffled >= observed[t] - 1e-12).sum()
+            done[t] += size
+
+        if early_stop:
+            remaining = permutations - done
+            never_significant = (exceed + 1)/(permutations + 1) > alpha
+            always_significant = (exceed + remaining + 1)/(permutations + 1) <= alpha
+            active &= ~(never_significant | always_significant)
+
+    pvalues = (exceed + 1)/(done + 1)
+    null = _np.array([_np.percentile(_np.concatenate(n), 100*_np.array(quantiles)) for n in null]).T
+
+    return pvalues, _np.atleast_2d(null)
+
+
+class entropy_cache:
+    '''
+    Entropies of sets of (possibly shifted) label arrays, cached such that information terms sharing a set
+    of labels compute its entropy only once. For example H(g) is shared by the basal and gating information
+    curves, and H(X,Y,Z) of one chain rule term is H(X,Z) of the next one.
+
+    A variable is a tuple (name, lag), its value at time point p is labels[name][p-lag].
+    Information terms are only defined at time points p >= the largest lag among their variables and are 0
+    before that (as in get_discrete and get_cond_discrete).
+
+    inputs:
+    -------
+        labels:         dictionary, each value a 2d int ndarray (or tuple of tuples) such that labels[name][i][j]
+                        is sample j at time point i. All of them with the same shape
+
+        backend, estimator, n_jobs:     see mi
+
+        symbolsN:       optional dictionary with the alphabet size of some (or all) names, for example binsN+2 for
+                        binned labels. Missing names default to labels[name].max()+1. The alphabet of a set of
+                        variables is the product of theirs ('panzeri_treves' and 'nsb' need the true sizes, see _entropy)
+    '''
+    def __init__(self, labels, backend='auto', estimator='plugin', n_jobs=1, symbolsN=None):
+        self.labels = {name: _as_codes(l) for name, l in labels.items()}
+        self.symbolsN = {name: int(l.max()) + 1 for name, l in self.labels.items()}
+        if symbolsN is not None:
+            self.symbolsN.update(symbolsN)
+        self.pntsN = len(next(iter(self.labels.values())))
+        self.backend = backend
+        self.estimator = estimator
+        self.n_jobs = n_jobs
+        self._entropies = {}
+
+    def entropy(self, variables):
+        '''
+        entropy of the set of variables at every time point (cached)
+        '''
+        key = frozenset(variables)
+
+        if key not in self._entropies:
+            # names can be of any type, sort them as strings to always combine codes in the same order
+            variables = sorted(key, key=str)
+            max_lag = max(lag for _, lag in variables)
+            codes = _combine_codes(*[self.labels[name][max_lag-lag:self.pntsN-lag] for name, lag in variables])
+            symbolsN = int(_np.prod([float(self.symbolsN[name]) for name, _ in variables]))
+
+            entropy = _np.zeros(self.pntsN)
+            if self.n_jobs != 1 and len(codes) > 1:
+                entropy[max_lag:] = _parallel_rows(_entropy, (codes,), self.n_jobs, backend=self.backend, estimator=self.estimator, symbolsN=symbolsN)
+            else:
+                entropy[max_lag:] = _entropy(codes, self.backend, estimator=self.estimator, symbolsN=symbolsN)
+            self._entropies[key] = entropy
+
+        return self._entropies[key]
+
+    def mi(self, x, y):
+        '''
+        I(x; y) at every time point, x and y are lists of variables
+        '''
+        x, y = set(x), set(y)
+        info = self.entropy(x) + self.entropy(y) - self.entropy(x | y)
+        info[:max(lag for _, lag in x | y)] = 0
+
+        return info
+
+    def cond_mi(self, x, y, z):
+        '''
+        I(x; y | z) at every time point, x, y and z are lists of variables
+        '''
+        x, y, z = set(x), set(y), set(z)
+        if not z:
+            return self.mi(x, y)
+
+        info = self.entropy(x | z) + self.entropy(y | z) - self.entropy(x | y | z) - self.entropy(z)
+        info[:max(lag for _, lag in x | y | z)] = 0
+
+        return info
+
+    def chain_rule(self, x, name, N):
+        '''
+        Chain rule decomposition of the information that the N letter word of 'name' ending at each time point
+        carries about x.
+
+        output:
+        -------
+            terms:      2d ndarray (N x time), terms[i] = I(x; letter i | letters 0 to i-1), letters sorted from
+                        the oldest (lag N-1) to the newest (lag 0). terms.sum(axis=0) is the information of the word.
+        '''
+        letters = [(name, N-1-i) for i in range(N)]
+        return _np.array([self.cond_mi(x, letters[i:i+1], letters[:i]) for i in range(N)])
+
+    def word_mi(self, x, name, N):
+        '''
+        output:
+        -------
+            info:       2d ndarray (N x time), info[k-1] is the information that the k letter word of 'name'
+                        ending at each time point carries about x, for k = 1, ..., N
+        '''
+        return _np.array([self.mi(x, [(name, lag) for lag in range(k)]) for k in range(1, N+1)])
+
+
 def report_information_stats(llength):
     '''
     Grab certain arrays and compute the peak, time to peak and peak duration
@@ -606,7 +1726,7 @@ def report_information_stats(llength):
     print('Information rate maximum during gating is {0}'.format(_np.diff(gating_8L).max()))
 
 
-def get_cond_discrete(binned_g, letters_list):
+def get_cond_discrete(binned_g, letters_list, n_jobs=1, estimator='plugin', cache=None, symbolsN=None):
     '''
     Compute I(g(t) ; letters_list[-1](t) | letters_list[:-1](at previous times))
 
@@ -619,43 +1739,47 @@ def get_cond_discrete(binned_g, letters_list):
 
         letters_list:       Each element of the list should be a 2d ndarray the same shape as g and holds the output of passing g through a given nonlinear object followed by binning
 
+        n_jobs:             number of processes to split time points among (see mi)
+
+        estimator:          entropy estimator, 'plugin' (default), 'miller_madow', 'panzeri_treves', 'quadratic' or 'nsb' (see _entropy)
+
+        cache:              optional entropy_cache with binned_g as 'g' and letters_list[i] as i (n_jobs, estimator and symbolsN are then taken from the cache)
+
+        symbolsN:           optional tuple, alphabet size of binned_g and of each letter, binsN+2 if binned with percentile_binner.
+                            Defaults to max+1 of each array. 'panzeri_treves' and 'nsb' need the true sizes (see _entropy)
+
     output:
         cond_discrete:          at each point in time, I(x, y | z)
     
     Implementation notes:
-        for each point along the time axis, extract the last value of g (x), the last letter (y) and the previous letters (z). Then feed all that into _discrete.cond_mi(x, y, z)
+        for each point along the time axis, extract the last value of g (x), the last letter (y) and the previous letters (z).
+        H(XZ), H(YZ), H(XYZ) and H(Z) are computed for all time points at once by an entropy_cache, passing
+        one allows reusing entropies across calls (H(Z) and H(XZ) of a word are H(YZ) and H(XYZ) of the word one letter shorter)
 
     '''
     #_ipdb.set_trace()
 
     lettersN = len(letters_list)
 
-    cond_discrete = _np.zeros(len(binned_g))
-
-    #if lettersN > 2:
-    #    raise ValueError("naturalscenes.get_cond_discrete:\n I'm assuming in the implementation that there are exactly 2 letters.\n Expand implementation as needed")
+    if cache is None:
+        labels = {i: letters for i, letters in enumerate(letters_list)}
+        labels['g'] = binned_g
+        if symbolsN is not None:
+            symbolsN = dict([('g', symbolsN[0])] + [(i, symbolsN[1]) for i in range(lettersN)])
+        cache = entropy_cache(labels, estimator=estimator, n_jobs=n_jobs, symbolsN=symbolsN)
 
     # I can only compute the cond_discrete if last letter is such that the 1st letter is in the simulation. That means that I can't compute the cond_discrete for the first lettersN-1 points
+    # when lettersN is 2,   i=0 and letters are taken from letters_list[0][p-1]
+    # when lettersN is 3,   i=0-> letters_list[0][p-2]
+    #                       i=1-> letters_list[1][p-1]
+    x = [('g', 0)]
+    y = [(lettersN-1, 0)]
+    z = [(i, lettersN-i-1) for i in range(lettersN-1)]
 
-    for p in range(lettersN-1, len(binned_g)):
-        x = binned_g[p]
+    return cache.cond_mi(x, y, z)
 
-        y = letters_list[-1][p]
 
-        z = ()
-        for i in range(lettersN-1):
-            # when lettersN is 2,   i=0 and letters are taken from letters_list[0][p-letters_delta_p]
-            # when lettersN is 3,   i=0-> letters_list[0][p-2*letters_delta_p]
-            #                       i=1-> letters_list[1][p-1*letters_delta_p]
-            z += (letters_list[i][p-(lettersN-i-1)],)
-        
-        newZ = _discrete.combine_labels(*z)
-        cond_discrete[p] = _discrete.cond_mi(x, y, newZ)
-
-    return cond_discrete
-
-
-def get_discrete(binned_g, letters_list):
+def get_discrete(binned_g, letters_list, n_jobs=1, estimator='plugin', symbolsN=None):
     '''
     Compute I(g(t) ; letters_list[:](t and previous times))
 
@@ -664,34 +1788,44 @@ def get_discrete(binned_g, letters_list):
     
     input:
     ------
-        g:                  tuple of tuples, now g[i] means all g values at time point i and g[i][j] is linear prediction for cell j, time point i
+        g:                  2d int ndarray (or tuple of tuples), g[i] means all g values at time point i and g[i][j] is linear prediction for cell j, time point i
+
+        letters_list:       Each element of the list should be shaped as 'g', holding the output of passing g through a given nonlinear object followed by binning
+
+        n_jobs:             number of processes to split time points among (see mi)
 
-        letters_list:       Each element of the list should be a tuple of tuple as 'g', holding the output of passing g through a given nonlinear object followed by binning
+        estimator:          entropy estimator, 'plugin' (default), 'miller_madow', 'panzeri_treves', 'quadratic' or 'nsb' (see _entropy)
+
+        symbolsN:           optional tuple, alphabet size of binned_g and of each letter, binsN+2 if binned with percentile_binner.
+                            The alphabet of the words is then symbolsN[1]**len(letters_list).
+                            Defaults to max+1 of binned_g and of the words. 'panzeri_treves' and 'nsb' need the true sizes (see _entropy)
 
     output:
         info:               at each point in time, I(x, y)
     
     Implementation notes:
-        for each point along the time axis, extract the last value of g (x), the set of N letters ending on time t (y). Then feed all that into _discrete.mi(x, y)
+        for each point along the time axis, extract the last value of g (x), the set of N letters ending on time t (y). Then feed all that into mi(x, y)
+        All time points are computed at once, shifting the letters rather than looping over time.
 
     '''
     #_ipdb.set_trace()
 
     lettersN = len(letters_list)
+    binned_g = _as_codes(binned_g)
+    pntsN = len(binned_g)
 
-    info = _np.zeros(len(binned_g))
+    info = _np.zeros(pntsN)
 
     # I can only compute the info if time is such that I can extract (lettersN-1) prior to current time. That means that for the first (lettersN-1) points I can't compute the information.
-    for p in range(lettersN-1, len(binned_g)):
-        x = binned_g[p]
+    x = binned_g[lettersN-1:]
 
-        y = ()
-        for i in range(lettersN):
-            # When there is only 1 letter in letters_list, N-i-1 = 0 and 'y' is taken at point 'p' as is 'x'. With two letters, first one is taken at 'p-letters_delta_p' and second one is taken at 'p'
-            y += (letters_list[i][p-(lettersN-i-1)],)
-        
-        newY = tuple(zip(y))#_discrete.combine_labels(*y)
-        info[p] = _discrete.mi(x, newY)
+    # When there is only 1 letter in letters_list, N-i-1 = 0 and 'y' is taken at point 'p' as is 'x'. With two letters, first one is taken at 'p-1' and second one is taken at 'p'
+    y = _combine_codes(*[_as_codes(letters_list[i])[i:pntsN-(lettersN-i-1)] for i in range(lettersN)])
+
+    if symbolsN is not None:
+        symbolsN = (symbolsN[0], symbolsN[1]**lettersN)
+
+    info[lettersN-1:] = mi(x, y, n_jobs=n_jobs, estimator=estimator, symbolsN=symbolsN)
 
     return info
 
@@ -709,6 +1843,7 @@ def average(array_in, pnts, flag):
                     4, average fewer points in the last bin
             
     Implementation Notes: I will reshape array_in into a 2d array such that shape[1] = pnts. Then I'll compute the mean along axis = 1. Then reshape back into something with the same number in the 1st dimensions of shape
+        The output has the same dtype as array_in (float32 stays float32, see sim_dtype), means over pnts are short enough not to need float64 accumulation
 
     '''
 
@@ -722,10 +1857,10 @@ def average(array_in, pnts, flag):
             array_in = array_in[extra_points:]
         elif flag == 3:
             first_bin = array_in[:extra_points].mean()
-            array_in = _np.concatenate((_np.ones(pnts-extra_points)*first_bin, array_in.flatten()), axis=0)
+            array_in = _np.concatenate((_np.full(pnts-extra_points, first_bin, dtype=array_in.dtype), array_in.flatten()), axis=0)
         elif flag == 4:
             last_bin = array_in[-extra_points:].mean()
-            array_in = _np.concatenate((array_in.flatten(), _np.ones(pnts-extra_points)*last_bin), axis=0)
+            array_in = _np.concatenate((array_in.flatten(), _np.full(pnts-extra_points, last_bin, dtype=array_in.dtype)), axis=0)
 
     shape_out = array_in.shape[:-1] + (-1,)
     #array_out = array_in.reshape(-1, pnts).mean(axis=1).reshape(shape_out)
@@ -751,6 +1886,116 @@ def average(array_in, pnts, flag):
     return outArray
     """
 
+def average_pyramid(array_in, pnts_list, flag):
+    '''
+    Same as average(array_in, pnts, flag) but for every pnts in pnts_list at once, and pnts does not need to be
+    an integer (letter lengths that are not a multiple of sim_delta_t).
+
+    The cumulative sum of array_in along the last dimension (time) is computed once, in float64, and the average
+    over any window [t0, t1) comes from its difference. Windows that start or end in between points take the
+    corresponding fraction of that point (array_in is considered constant over each sim_delta_t).
+    Unlike average, each row is averaged on its own (array_in is not flattened).
+
+    input:
+    ------
+        pnts_list:  iterable with the number of points in each letter
+
+        flag:       what to do when array_in.shape[-1] is not an integer number of pnts, same as in average
+                    0, raise an error
+                    1, throw away extra points at the end
+                    2. throw away extra points at the beginning
+                    3, average fewer points in the 1st bin
+                    4, average fewer points in the last bin
+
+    output:
+    -------
+        averages:   list with one ndarray per pnts in pnts_list, same dtype as array_in
+    '''
+    array_in = _np.asarray(array_in)
+    points = array_in.shape[-1]
+
+    cumsum = _np.zeros(array_in.shape[:-1] + (points+1,))
+    _np.cumsum(array_in, axis=-1, dtype=float, out=cumsum[..., 1:])
+
+    averages = []
+    for pnts in pnts_list:
+        edges = _letters_edges(points, pnts, flag)
+
+        # integral of array_in from 0 to each edge, linear interpolation of cumsum
+        lower = _np.minimum(_np.floor(edges).astype(int), points-1)
+        frac = edges - lower
+        integral = cumsum[..., lower] + frac * (cumsum[..., lower+1] - cumsum[..., lower])
+
+        averages.append((_np.diff(integral, axis=-1)/_np.diff(edges)).astype(array_in.dtype, copy=False))
+
+    return averages
+
+def _letters_edges(points, pnts, flag):
+    '''
+    return a 1D ndarray with the edges (in points, possibly not integers) of the letters of 'pnts' points that fit
+    in an array with 'points' points along time. See average for the meaning of 'flag'
+    '''
+    lettersN = int(_np.floor(points/pnts + 1E-9))
+    extra_points = points - lettersN*pnts
+    if extra_points < 1E-9 * pnts:
+        extra_points = 0
+
+    edges = _np.arange(lettersN+1)*pnts
+    if extra_points:
+        if flag == 0:
+            raise ValueError('naturalscenes.average_pyramid: array_in.shape[-1] is not an integer number of pnts')
+        elif flag == 2:
+            edges += extra_points
+        elif flag == 3:
+            edges = _np.concatenate(([0], edges + extra_points))
+        elif flag == 4:
+            edges = _np.concatenate((edges, [points]))
+
+    edges[-1] = min(edges[-1], points)
+    return edges
+
+def _letters_number(points, pnts, flag):
+    '''
+    number of letters average_pyramid returns for an array with 'points' points along time
+    '''
+    return len(_letters_edges(points, pnts, flag)) - 1
+
+def codes_from_ranks(ranks, referenceN, binsN):
+    '''
+    Convert ranks (output of percentile_binner.ranks) into binned codes for any number of bins, using only
+    integer arithmetic. This allows sweeping binsN without going back to the float data.
+
+    inputs:
+    -------
+        ranks:          ndarray of ints, number of reference values <= each value
+
+        referenceN:     int, number of values in the reference data (len(percentile_binner.reference))
+
+        binsN:          number of bins
+
+    output:
+    -------
+        codes:          ndarray, same shape as ranks, uint8 (uint16 if binsN > 254), values in range(binsN+2).
+
+    Codes are exact (the same as _np.digitize(values, percentile_bins)) only for values that are in the reference data,
+    ie: the reference column(s) used in percentile_binner.fit. For any other value (other time points) they are an
+    approximation: a rank only says in between which two consecutive reference values a value falls, and when a bin
+    edge is interpolated in between those same two reference values the value is assigned to the lower bin, while
+    digitize would put it in the upper one if it is above the edge. Codes are then off by one bin for those values.
+    Use percentile_binner(binsN).fit(...).transform(values) when exact codes are needed for all time points.
+
+    Implementation notes:
+        A value with rank r >= 1 sits at position r-1 of the sorted reference. The percentile bins are at
+        positions k*(referenceN-1)/binsN, k = 0, ..., binsN, and digitize counts how many of them are <= r-1
+    '''
+    ranks = _np.asarray(ranks).astype(_np.int64)
+    dtype = _np.uint8 if binsN + 2 <= 256 else _np.uint16
+
+    codes = (ranks - 1) * binsN // max(referenceN - 1, 1) + 1
+    codes[ranks == 0] = 0
+
+    return codes.astype(dtype)
+
 def _getImagesPath(path=None):
     if path is None:
         path = '/Users/jadz/Documents/Notebook/Matlab/Natural Images DB/RawData/*/*LUM.mat'
@@ -892,6 +2137,41 @@ def _get_simulation_TAX():
 
     return tax
 
+def _dtype_path(path, dtype=None):
+    '''
+    Return the file name used to store an array of the given dtype (defaults to sim_dtype) at 'path'.
+
+    float64 arrays keep the original name (all files written before sim_dtype existed are float64),
+    any other dtype gets the dtype appended, for example 'linear_prediction_float32'.
+    This prevents reading a float64 file as float32 (or viceversa) without noticing.
+    '''
+    if dtype is None:
+        dtype = sim_dtype
+
+    dtype = _np.dtype(dtype)
+    if dtype == _np.float64:
+        return path
+
+    return '{0}_{1}'.format(path, dtype.name)
+
+def _fromfile(path, dtype=None):
+    '''
+    Load an array saved with tofile under _dtype_path(path, dtype) and return it as 'dtype' (defaults to sim_dtype).
+    If only the float64 version exists, it is loaded and converted.
+
+    Raises IOError if neither file exists.
+    '''
+    if dtype is None:
+        dtype = sim_dtype
+
+    if os.path.isfile(_dtype_path(path, dtype)):
+        return _np.fromfile(_dtype_path(path, dtype), dtype=dtype)
+
+    if os.path.isfile(path):
+        return _np.fromfile(path).astype(dtype, copy=False)
+
+    raise IOError('{0} does not exist'.format(path))
+
 # plots go here
 def plot_g(g, num):
     '''
@@ -1091,6 +2371,10 @@ def plot_word_information_2(FEM_folder, letters_folder, llength, letters_N):
     basal_discrete = _np.fromfile(os.path.join(letters_folder, 'mi_{0}b_0g'.format(letters_N)))
     gating_discrete = _np.fromfile(os.path.join(letters_folder, 'mi_0b_{0}g'.format(letters_N)))
 
+    # significance thresholds, only if process() computed them (see mi_null_permutations)
+    basal_null_file = os.path.join(letters_folder, 'mi_{0}b_0g_null95'.format(letters_N))
+    gating_null_file = os.path.join(letters_folder, 'mi_0b_{0}g_null95'.format(letters_N))
+
     gsd = _np.fromfile(os.path.join(FEM_folder, 'gsd'))
     g_tax = _np.arange(sim_start_t, sim_end_t, sim_delta_t)
 
@@ -1114,6 +2398,10 @@ def plot_word_information_2(FEM_folder, letters_folder, llength, letters_N):
     ########################## Panel 2
     ax[1].plot(tax, gating_discrete, 'b', lw=2)
     ax[1].plot(tax, basal_discrete, 'r', lw=2)
+    if os.path.isfile(gating_null_file):
+        ax[1].plot(tax, _np.fromfile(gating_null_file), 'b--', lw=1, label='_nolegend_')
+    if os.path.isfile(basal_null_file):
+        ax[1].plot(tax, _np.fromfile(basal_null_file), 'r--', lw=1, label='_nolegend_')
     ax[1].plot([0,0], ax[1].get_ylim(), ':k', label='_nolegend_')
 
     yticks=range(0,6,2)
@@ -1319,12 +2607,15 @@ def explore_all_nl(g, time, nls):
     hist, bins, patches = ax1.hist(data_to_hist, bins=bins, normed=True, color='k', histtype='bar', label=label)
 
     #_ipdb.set_trace()
-    # plot nl in the same bins
-    max_rate = -_np.inf
-    for nl in nls:
-        ax2.plot(bins, nl.torate(bins)/nl.gating_nl.max_fr, colors[0], label=r'$no gating$', lw=1, alpha=.5)
-        ax2.plot(bins, nl.gating_rate(bins)/nl.gating_nl.max_fr, colors[1], label=r'$gating$', lw=1, alpha=.5)
-        max_rate = max(max_rate, (nl.gating_rate/nl.gating_nl.max_fr).max())
+    # plot nl in the same bins, all nonlinearities are evaluated at once (see nonlinear_bank)
+    gating_bank = nonlinear_bank([nl.gating_nl for nl in nls])
+    max_fr = gating_bank.max_fr[:, _np.newaxis]
+    nogating_rates = nonlinear_bank(nls).torate(bins)/max_fr
+    gating_rates = gating_bank.torate(bins)/max_fr
+    for nogating_rate, gating_rate in zip(nogating_rates, gating_rates):
+        ax2.plot(bins, nogating_rate, colors[0], label=r'$no gating$', lw=1, alpha=.5)
+        ax2.plot(bins, gating_rate, colors[1], label=r'$gating$', lw=1, alpha=.5)
+    max_rate = gating_rates.max()
     
     #arange axis
     ax1.xaxis.set_ticks_position('bottom')
@@ -1386,8 +2677,9 @@ def explore_one_cell_nl(g, time, nls, bin_rate=None):
     if not _np.iterable(nls):
         nls = [nls]
 
-    for i, nl in enumerate(nls):
-        ax2.plot(bins, nl.torate(bins, bin_rate=bin_rate), colors[0], lw=2)
+    rates = nonlinear_bank(nls).torate(bins, bin_rate=bin_rate)
+    for i in range(len(rates)):
+        ax2.plot(bins, rates[i], colors[0], lw=2)
 
     #arange axis
     ax1.xaxis.set_ticks_position('bottom')
@@ -2510,8 +3802,7 @@ def plot_cond_proba(g, t0, t1, binsN):
 
     # Discretize subG
     p_at_100ms = int((0.1-sim_start_t)/sim_delta_t)
-    percentiles = list(_np.arange(0, 100.1, 100/binsN))
-    bins = _np.percentile(g[:, p_at_100ms], percentiles)
+    bins = percentile_binner(binsN).fit(g, p_at_100ms).bins
     #binned_g    = _np.digitize(g[:,[p0,p1]].flatten(), bins).reshape(g[:,[p0,p1]].shape)
 
     # compute a 2D histogram of binned_g using bins
@@ -2753,6 +4044,16 @@ def plot_simulation_and_gaussian(g, gaussian_lp):
 
 # plots go here
 
+def _gaussian_entropy(cov):
+    '''
+    Entropy (in bits) of a gaussian with covariance cov. cov can be a stack of covariance matrices
+    (... x k x k) in which case all entropies are computed with a single call to slogdet.
+    '''
+    k = cov.shape[-1]
+    sign, logdet = _np.linalg.slogdet(cov)
+    return 0.5*(k*_np.log2(2*_np.pi*_np.e) + logdet/_np.log(2))
+
+
 def information(cov, X):
     '''
     cov is the covariance matrix of the simulation. Each point along either of the two axis represents a point in time (from sim_start_t to sim_end_t in steps of length sim_delta_t)
@@ -2765,20 +4066,44 @@ def information(cov, X):
         cov:    2D ndarray, covariance matrix of the linear prediction
 
         X:      iterable of ints, points relative to each point in the time axis to compute MI with
+                or a list of such iterables (patterns do not need to have the same length)
 
     outputs:
     --------
         information     1D ndarray, each point has the information between that point and X
                         size of output is same as cov.shape[0]
+                        NaN where X+p falls outside the simulation
+                        2D ndarray (len(X) x cov.shape[0]) if X is a list of patterns
                         
+    Implementation notes:
+        MI(X+p, p) = 0.5*log2(det(cov[X+p, X+p]) * cov[p,p] / det(cov[X+p & p, X+p & p]))
+        All valid (pattern, p) pairs of patterns with the same length are extracted as a single
+        (pairs x k+1 x k+1) stack and evaluated with one batched slogdet.
     '''
+    patterns = X if len(X) and _np.iterable(X[0]) else [X]
+    patterns = [_np.asarray(x, dtype=int) for x in patterns]
+    pntsN = cov.shape[0]
 
-    # first lets convert X to ndarray it it is not
-    if not isinstance(X, _np.ndarray):
-        X = _np.array(X, dtype='int')
-    
-    return _np.array([_discrete.gaussianInformation(cov, X+p, [p]) if p+X.min()>=0 and p+X.max()<cov.shape[0] else _np.nan for p in range(cov.shape[0])])
-    #return [(X+p, p) if p+X.min()>=0 and p+X.max()<cov.shape[0] else _np.nan for p in range(cov.shape[0])]
+    info = _np.full((len(patterns), pntsN), _np.nan)
+
+    for k in set(len(x) for x in patterns):
+        rows = [i for i, x in enumerate(patterns) if len(x) == k]
+        x = _np.array([patterns[i] for i in rows])
+
+        # all valid (pattern, p) pairs, X+p has to be inside the simulation
+        row, p = _np.nonzero((_np.arange(pntsN) + x.min(axis=1)[:, _np.newaxis] >= 0) & (_np.arange(pntsN) + x.max(axis=1)[:, _np.newaxis] < pntsN))
+        allPoints = _np.concatenate((x[row] + p[:, _np.newaxis], p[:, _np.newaxis]), axis=1)
+
+        subCov = cov[allPoints[:, :, _np.newaxis], allPoints[:, _np.newaxis, :]]
+        XY = _np.linalg.slogdet(subCov)[1]
+        XX = _np.linalg.slogdet(subCov[:, :k, :k])[1]
+
+        info[_np.array(rows)[row], p] = 0.5*(XX + _np.log(cov[p, p]) - XY)/_np.log(2)
+
+    if len(X) and _np.iterable(X[0]):
+        return info
+
+    return info[0]
 
 def _getCondInfoP0(cov, covN, p0, condListLP, condListLPN):
     '''
@@ -2845,45 +4170,68 @@ def _extractSubCov(covLP, covN, noiselessPoints, noisyPoints):
         covLP:  2D ndarray, covariance matrix of the linear prediction, comes from the simulation
 
         covN:   2D ndarray, covariance matrix of the noise, comes from the variance in the simulation and Yusuf's intracellular data
+                1D ndarray is also accepted and taken as the (precomputed) diagonal of the noise covariance, noise
+                being uncorrelated in time. A scipy.sparse matrix (see getNoiseCovariance) is also accepted.
 
         noiselessPoints:     list of ints. Each point corresponds to g(t) through p=(t-sim_start_t)/sim_delta_t
         
         noisyPoints:         list of ints. Each point corresponds to g(t)+noise through p=(t-sim_start_t)/sim_delta_t
 
+                             Either of them can also be a 2D array of ints (batch x points), all rows of the
+                             same length, and then one submatrix is extracted per row (a 1D list is used for every row)
+
     output:
     -------
         subCov:   2D ndarray, the covariance matrix of the points choosen
+                  3D ndarray (batch x (A+B) x (A+B)) if points are given in batches
 
-        I will generate the covariance matrix between LP and LP + Noise for the time points requested. The covariance between different time points of LP is just a submatrix of LP. The covariance matrix between different time points of LP + noise is a submatrix of covarianceLP + the corresponding diagonal terms from covN. The covariance matrix between g(t0) and g(t1)+N is a submatrix of cov (at t0, and t1) with noise from covN added to t1 and no off diagonal element because I'm assuming that noise is uncorrelated in time.
-    '''
+        I will generate the covariance matrix between LP and LP + Noise for the time points requested. The covariance between different time points of LP is just a submatrix of LP. The covariance matrix between different time points of LP + noise is a submatrix of covarianceLP + the corresponding submatrix of covN. The covariance matrix between g(t0) and g(t1)+N is a submatrix of cov (at t0, and t1) with no noise contribution, noise only enters the noisy x noisy block.
+
+    Implementation notes:
+        submatrices are extracted with fancy indexing (_np.ix_ for a single set of points), only the (A+B)**2
+        requested elements are ever copied
+    '''
+    noiselessPoints = _np.asarray(noiselessPoints, dtype=int)
+    noisyPoints = _np.asarray(noisyPoints, dtype=int)
+    batched = noiselessPoints.ndim == 2 or noisyPoints.ndim == 2
+
+    if not batched:
+        allPoints = _np.concatenate((noiselessPoints, noisyPoints))
+        if len(allPoints)==0:
+            return _np.array([])
+
+        subCov = covLP[_np.ix_(allPoints, allPoints)]
+
+        # noise only contributes to the block of noisy points
+        N0 = len(noiselessPoints)
+        if hasattr(covN, 'toarray'):
+            subCov[N0:, N0:] += covN[_np.ix_(noisyPoints, noisyPoints)].toarray()
+        elif covN.ndim == 1:
+            subCov[N0:, N0:] += _np.where(noisyPoints[:, _np.newaxis] == noisyPoints, covN[noisyPoints], 0)
+        else:
+            subCov[N0:, N0:] += covN[_np.ix_(noisyPoints, noisyPoints)]
 
-    allPoints = noiselessPoints + noisyPoints
+        return subCov
 
-    if allPoints==[]:
-        return _np.array([])
+    # batches, a list of points (1D) is shared by all rows
+    batchN = max(len(p) for p in (noiselessPoints, noisyPoints) if p.ndim == 2)
+    noiselessPoints = _np.broadcast_to(_np.atleast_2d(noiselessPoints), (batchN, noiselessPoints.shape[-1]))
+    noisyPoints = _np.broadcast_to(_np.atleast_2d(noisyPoints), (batchN, noisyPoints.shape[-1]))
+    allPoints = _np.concatenate((noiselessPoints, noisyPoints), axis=1)
 
-    # extract the subarray corresponding to allPoints from covLP. I'm taking points with 'take' from a flatten version of cov. At this point in the code, there is no reference to the noise
-    from itertools import product
-    subCovG = _np.array([_np.take(covLP.flatten(), coord[0]+covLP.shape[0]*coord[1]) for coord in product(allPoints, allPoints)]).reshape(-1, len(allPoints))
-    #print(subCov)
-    
-    # In delaing with noisy point I replace all noiseless points by None such that testing becomes simple. Now after product if any of the points comes from noiselessPoints, the test "None in coord" will return True
-    allPoints = [None]*len(noiselessPoints) + noisyPoints
-    subCovN = _np.array([0 if None in coord else _np.take(covN.flatten(), coord[0]+covN.shape[0]*coord[1]) for coord in product(allPoints, allPoints)]).reshape(-1, len(allPoints))
-    
-    return subCovG + subCovN
-    '''
-    # add noise in the diagonal terms corresponding to noisyPoints. Since I'm assuming that different time points have noise that is uncorrelated, then there are no contributions to off diagonal terms, unless there is a point more than once in noisyPoints. In that case, the contribution to the off diagonal term is covN[p,p]
-    #_ipdb.set_trace()
-    N0 = len(noiselessPoints)   # all N0 first dimensions of subCov correspond to noiseless points
-    N1 = len(noisyPoints)       # then, there are N1 dimesnions with noise.
+    subCov = covLP[allPoints[:, :, _np.newaxis], allPoints[:, _np.newaxis, :]]
 
-    for i, coords in enumerate(product(noisyPoints, noisyPoints)):
-        if coords[0]==coords[1]:
-            i0 = _np.mod(i, N1)+N0
-            i1 = _np.floor(i/N1)+N0
-            subCov[i0, i1] += covN[coords]
-    '''
+    N0 = noiselessPoints.shape[1]
+    if hasattr(covN, 'toarray'):
+        rows = _np.broadcast_to(noisyPoints[:, :, _np.newaxis], noisyPoints.shape + noisyPoints.shape[-1:])
+        cols = _np.broadcast_to(noisyPoints[:, _np.newaxis, :], rows.shape)
+        subCov[:, N0:, N0:] += _np.asarray(covN.tocsr()[rows.ravel(), cols.ravel()]).reshape(rows.shape)
+    elif covN.ndim == 1:
+        subCov[:, N0:, N0:] += _np.where(noisyPoints[:, :, _np.newaxis] == noisyPoints[:, _np.newaxis, :], covN[noisyPoints][:, :, _np.newaxis], 0)
+    else:
+        subCov[:, N0:, N0:] += covN[noisyPoints[:, :, _np.newaxis], noisyPoints[:, _np.newaxis, :]]
+
+    return subCov
 
 def get_discrete_per_spike(llength, letters_N):
     '''
@@ -2999,7 +4347,7 @@ def getInfo0(covG, covN):
     '''
     return _np.array( [0.5 * _np.log2(1 + covG[i,i]/covN[i,i]) for i in range(covG.shape[0])])
 """    
-def getNoiseCovariance(covG, sim_noise_fit, decay_time):
+def getNoiseCovariance(covG, sim_noise_fit, decay_time, sparse=False):
     '''
     ******** Very Important *********
     * Everything is in the simulation units and not in Yusuf's units.
@@ -3028,11 +4376,21 @@ def getNoiseCovariance(covG, sim_noise_fit, decay_time):
         sim_noise_fit (poly1d object):      linear fit to sim_nosie_sd vs sim_mp_sd
 
         decay_time:     time points t0 and t1 have noise that is correlated according to exp(-abs(t0-t1)/decay_time)
+                        None means uncorrelated noise and then only the diagonal is returned (1D ndarray, accepted
+                        as covN by _extractSubCov, _getCondInfoP0 and newInformation)
+
+        sparse:         if True, return a scipy.sparse (csr) matrix holding only the band. _extractSubCov,
+                        _getCondInfoP0, _chain_rule_discrete and newInformation accept it as covN
 
 
     output:
     -------
         noise:  noise the cell would experience under such input variance
+
+    Implementation notes:
+        covN[i,j] = sd[i] * sd[j] * exp(-|i-j|*sim_delta_t/decay_time) for |i-j| < max_distance and 0 otherwise,
+        with sd = |sim_noise_fit(sqrt(diag(covG)))|. It is built as the outer product of sd times a Toeplitz
+        decay factor (or diagonal by diagonal when sparse)
     '''
     #_ipdb.set_trace()
 
@@ -3040,27 +4398,32 @@ def getNoiseCovariance(covG, sim_noise_fit, decay_time):
     if not _np.iterable(covG):
         return sim_noise_fit(_np.sqrt(covG))**2
 
-    # generate the covariance matrix for the noise. same shape as covG
-    covN = _np.zeros_like(covG)
+    # the diagonal values are computed from Yusuf's intracellular data, all at once
+    noise_sd = _np.abs(sim_noise_fit(_np.sqrt(_np.diag(covG))))
 
-    # the diagonal values are computed from Yusuf's intracellular data
-    for i in range(covG.shape[0]):
-        covN[i,i] = sim_noise_fit(_np.sqrt(covG[i,i]))**2
+    if decay_time is None:
+        return noise_sd**2
 
-    # To speed things I'm first computing the delay in points beyond which the correlation is too small (in those cases I will ignore it). Then I'll fill covN around the diagnol (skipping diagonal terms for which I already computed the noise
+    # correlations beyond max_distance are too small and are ignored
 
     max_distance = int(-_np.log(.1)*decay_time/sim_delta_t)     #log is the natural logarithm
                                                                 # .1 is a hardcoded constant signaling when exp(-t/tau) = 0.1
-    #_ipdb.set_trace()
-    for j in range(covG.shape[0]):
-        for dist in range(1, max_distance):
-            if j+dist>= covG.shape[0]:
-                continue
+    # the diagonal is always there, even if max_distance is 0
+    max_distance = max(max_distance, 1)
+    pntsN = len(noise_sd)
 
-            covN[j+dist, j] = _np.sqrt(covN[j+dist,j+dist]*covN[j,j])*_np.exp(-dist*sim_delta_t/decay_time)
-            covN[j, j+dist] = covN[j+dist, j]
-    
-    return covN
+    if sparse:
+        from scipy.sparse import diags
+
+        offsets = range(-(max_distance-1), max_distance)
+        offsets = [k for k in offsets if abs(k) < pntsN]
+        band = [noise_sd[:pntsN-abs(k)]*noise_sd[abs(k):]*_np.exp(-abs(k)*sim_delta_t/decay_time) for k in offsets]
+        return diags(band, offsets, shape=(pntsN, pntsN), format='csr')
+
+    dist = _np.abs(_np.subtract.outer(_np.arange(pntsN), _np.arange(pntsN)))
+    decay = _np.where(dist < max_distance, _np.exp(-dist*sim_delta_t/decay_time), 0)
+
+    return _np.outer(noise_sd, noise_sd)*decay
 
 def generate_peripheral_kernel(gating_start_t, gating_end_t, points, save_flag=0, display_flag=0):
     '''
@@ -3138,38 +4501,75 @@ def _chain_rule_discrete(covG, covN, p0, points):
     The information I'm computing is:   I(g(p0) ; g(p1)+n, ..., g(pn)      where p1, p2, ..., pn are in points
 
     And the chain rule is I(x0, x1, ..., xn; y) = I(x0; y) + I(x1;y | x0) + I(x2;y | x0, x1) + ... + I(xn; y | x0, x1, ..., x(n-1))
+
+    inputs:
+    -------
+        p0:         int or 1D array of ints. With an array, the decomposition is computed for every p0 in one call
+
+        points:     list of ints, the noisy points. With an array of p0s it can also be a 2D array (len(p0) x n)
+                    with a different list of points for each p0
+
+    output:
+    -------
+        condInfo:   1D ndarray, condInfo[i] is the i-th term in the chain rule
+                    2D ndarray (len(p0) x n) if p0 is an array
     
     Implemenation notes:
         I(X; Y | Z) = H(X | Z) - H(X | Y, Z)
                     = H(X, Z) - H(Z) - ( H(X, Y, Z) - H(Y, Z) )
                     = H(X, Z) + H(Y, Z) - H(X, Y, Z) - H(Z)
+
+        For gaussians, all terms come from a single Cholesky factor L of the joint covariance ordered as
+        (x0, ..., x(n-1), y). With s_i = L[y,y]**2 + sum_{j>=i} L[y,j]**2 = var(y | x0, ..., x(i-1)),
+        the i-th term is 0.5*log2(s_i/s_(i+1)).
+        If all p0 share the points, the factor of the noisy points is computed once and only the y row
+        (a triangular solve per p0, all at once) changes.
     '''
-    
-    # allocate ndarray output
-    condInfo = _np.zeros(len(points))
+    from scipy.linalg import solve_triangular
 
-    # first term in the expansion is not a conditional information, but the information between the stimulus at point p0 and the 1st noisy measurement from points
-    condInfo[0] = _discrete.gaussianInformation(_extractSubCov(covG, covN, [p0], [points[0]]), [0], [1])
-    
-    #_ipdb.set_trace()
-    for i in range(1, len(points)):
-        # According to the implementaion note, I will need to compute 4 different entropies. Extract the subCov corresponding for each one of them
-        # X is always the noisy contribution at points[i]
-        # Y is always the noiseless contribution at p0
-        # Z are the noisy points in 0:i (not counting i), therefore Z = points[:i]
-        XZ = _extractSubCov(covG, covN, [], points[:i+1])
-        YZ = _extractSubCov(covG, covN, [p0], points[:i])
-        XYZ = _extractSubCov(covG, covN, [p0], points[:i+1])
-        Z = _extractSubCov(covG, covN, [], points[:i])
-        
-        condInfo[i] = _discrete.gaussianEntropy(XZ) + _discrete.gaussianEntropy(YZ) - _discrete.gaussianEntropy(XYZ) - _discrete.gaussianEntropy(Z)
-        
-    return condInfo
+    batched = _np.ndim(p0) > 0
+    p0 = _np.atleast_1d(_np.asarray(p0, dtype=int))
+    points = _np.asarray(points, dtype=int)
+    n = points.shape[-1]
 
-def newInformation(covG, covN, letter_length):
+    if points.ndim == 1:
+        L = _np.linalg.cholesky(_extractSubCov(covG, covN, [], points))
+        # y row of the factor, L[y, :n] for every p0
+        Ly = solve_triangular(L, covG[_np.ix_(points, p0)], lower=True).T
+        Lyy2 = covG[p0, p0] - (Ly**2).sum(axis=1)
+    else:
+        # joint covariance ordered as (y, x0, ..., x(n-1)), move y to the end
+        joint = _extractSubCov(covG, covN, p0[:, _np.newaxis], points)
+        order = _np.roll(_np.arange(n+1), -1)
+        L = _np.linalg.cholesky(joint[:, order][:, :, order])
+        Ly = L[:, n, :n]
+        Lyy2 = L[:, n, n]**2
+
+    # s[:, i] = var(y | x0, ..., x(i-1)), for i = 0, ..., n
+    s = Lyy2[:, _np.newaxis] + _np.concatenate((_np.cumsum((Ly**2)[:, ::-1], axis=1)[:, ::-1], _np.zeros((len(p0), 1))), axis=1)
+    condInfo = 0.5*_np.log2(s[:, :-1]/s[:, 1:])
+
+    if batched:
+        return condInfo
+
+    return condInfo[0]
+
+def newInformation(covG, covN, letter_length=None):
     '''
     compute the mutual information between noiseless sample at point p0 and the noisy sample at point p0 conditioning on all previous noisy samples
 
+    inputs:
+    -------
+        covG:           2D ndarray, covariance matrix of the linear prediction
+
+        covN:           2D ndarray, covariance matrix of the noise (or 1D, its diagonal, see _extractSubCov)
+
+        letter_length:  float, in seconds. Previous noisy samples are taken every letter_length (rounded to
+                        a multiple of sim_delta_t). Defaults to None, meaning every point in the simulation
+
+    output:
+    -------
+        info:           1D ndarray, info[p] = I(g(p); g(p)+n | g(p-k*step)+n for k = 1, 2, ...)
 
     implementation notes:
         for each point p0, compute I(g(tn); t(tn)+n | g(t0)+n, g(t1)+n, ..., g(tn)+n)
@@ -3187,16 +4587,43 @@ def newInformation(covG, covN, letter_length):
     and H(X, Y, Zn) = H(X, Z(n+1))
 
     Therefore it is faster to first compute all timepoints of both type of entropies and then combine them
+
+        For gaussians this is I = 0.5*log2(var(X|Z)/var(X|Y,Z)). Points sharing the same history form a chain
+        (p, p+step, p+2*step, ...), and the Cholesky factor L of the noisy covariance of a chain is grown one
+        row at a time (one triangular solve, O(n**2) per point). With w = L^-1 cov(Z, X):
+            var(X|Z) = var(X) - |w|**2
+        and adding Y to Z appends (cov(X,Y) - l.w)/d to w, l and d being the new row and diagonal of L.
+        The whole curve costs O(T**3) instead of computing every prefix from scratch.
     '''
-    
+    from scipy.linalg import solve_triangular
+
     #_ipdb.set_trace()
+    pntsN = covG.shape[0]
+    step = 1 if letter_length is None else max(1, int(round(letter_length/sim_delta_t)))
+    if hasattr(covN, 'toarray'):
+        covN = covN.toarray()
+    noisyCov = covG + (covN if covN.ndim == 2 else _np.diag(covN))
+
+    info = _np.zeros(pntsN)
+
+    for first in range(min(step, pntsN)):
+        chain = _np.arange(first, pntsN, step)
+        C = noisyCov[_np.ix_(chain, chain)]     # among noisy samples
+        V = covG[_np.ix_(chain, chain)]         # between noisy and noiseless samples (noise is independent of g)
+        L = _np.zeros(C.shape)
+
+        for j, p in enumerate(chain):
+            # l: new row of the Cholesky factor, w: L^-1 cov(Z, X)
+            l, w = solve_triangular(L[:j, :j], _np.stack((C[:j, j], V[:j, j]), axis=1), lower=True).T if j else (_np.zeros(0), _np.zeros(0))
+            d = _np.sqrt(C[j, j] - l @ l)
+            L[j, :j] = l
+            L[j, j] = d
+
+            var_Z = V[j, j] - w @ w
+            var_YZ = var_Z - ((V[j, j] - l @ w)/d)**2
+            info[p] = 0.5*_np.log2(var_Z/var_YZ)
 
-    Zentropy = _np.zeros(covG.shape[0])
-    XZentropy = _np.zeros(covG.shape[0])
-    
-    for p in range(covG.shape[0]):
-        Zentropy[p] = _discrete.gaussianEntropy(_extractSubCov(covG, covN, [], list(range(p+1))))
-        XZentropy = _discrete.gaussianEntropy(_extractSubCov(covG, covN, [p], list(range(p+1))))
+    return info
 
 
 def _get_words(letter_times, gating_start_t, gating_end_t, g, covG, nogating_nl, gating_nl, gating_flag, binsN=None):
@@ -3260,29 +4687,38 @@ def _get_words(letter_times, gating_start_t, gating_end_t, g, covG, nogating_nl,
 
     return words
 
-def get_total_discrete_since_t0(binned_g, letters, t0):
+def get_total_discrete_since_t0(binned_g, letters, t0, backend='auto'):
     '''
     For every time point t >= t0, compute I(g(t); letters(t) | all g's and letters between to and t)
     
     This is the total information that a system accumulates over time
+
+    binned_g and letters are 2d int ndarrays (or tuples of tuples), binned_g[i][j] is sample j at time point i
+
+    Implementation notes:
+        Rather than re-building the words since t0 at every time point, each sample keeps an id for its
+        g word and another for its letters word. At every time point the new symbol is appended
+        (id * base + symbol) and ids are re-encoded to 0, 1, ... number of distinct words - 1, such that
+        they never grow beyond the number of samples.
     '''
 
     #_ipdb.set_trace()
     p0 = time_to_point(t0,0)
-    #delta_p = time_to_point(letter_length,0)
-    sub_g = ()
-    sub_L = ()
+    binned_g = _as_codes(binned_g)
+    letters = _as_codes(letters)
+
+    g_base = int(binned_g.max()) + 1
+    L_base = int(letters.max()) + 1
+    g_ids = _np.zeros(binned_g.shape[1], dtype=_np.int64)
+    L_ids = _np.zeros(letters.shape[1], dtype=_np.int64)
 
     total_discrete = _np.zeros(len(binned_g))
 
-    delta_p=1
-    for p in range(p0, len(binned_g), delta_p):
-        sub_g = sub_g + (binned_g[p],)
-        sub_L = sub_L + (letters[p],)
-        tup_g = tuple(zip(*sub_g))
-        tup_L = tuple(zip(*sub_L))
+    for p in range(p0, len(binned_g)):
+        g_ids = _np.unique(g_ids * g_base + binned_g[p], return_inverse=True)[1].reshape(-1)
+        L_ids = _np.unique(L_ids * L_base + letters[p], return_inverse=True)[1].reshape(-1)
 
-        total_discrete[p] = _discrete.mi(tup_g, tup_L)
+        total_discrete[p] = mi(g_ids[_np.newaxis, :], L_ids[_np.newaxis, :], backend)[0]
 
     return total_discrete
 
@@ -3382,7 +4818,7 @@ def info_between_fr_and_g(firing_rate, g, t1, binsN=8):
     #cov = _np.cov(firing_rate, g[:, p1])
     #return _discrete.gaussianInformation(cov, [0], [1])
 
-def fit_exp_to_simulation(g, df, nogating_t, gating_t, cell=None):
+def fit_exp_to_simulation(g, df, nogating_t, gating_t, cell=None, g_SDs=None):
     '''
     Load the sigmoidal nonlinearities form the experiments (during gating and FEM) and change their scaling to match the simulation
     
@@ -3399,6 +4835,8 @@ def fit_exp_to_simulation(g, df, nogating_t, gating_t, cell=None):
         cell (int):         which cell's NL to load, has to be in the range of the df
                             if not given a random one is picked
 
+        g_SDs (tuple):      optional, SD of g at nogating_t and gating_t. If not given it is computed from g
+
     outputs:
     --------
         nogating_sig:            parameters for the sigmoidal nonlinearity
@@ -3431,8 +4869,9 @@ def fit_exp_to_simulation(g, df, nogating_t, gating_t, cell=None):
         exp_gating_sig = df.iloc[cell][['TW3_w[0]', 'TW3_w[1]', 'TW3_w[2]', 'TW3_w[3]']].values
 
     # find out the SD of the linear prediction at the given times
-    nogating_SD = g[:, time_to_point(nogating_t,0)].std()
-    gating_SD = g[:, time_to_point(gating_t, 0)].std()
+    if g_SDs is None:
+        g_SDs = (g[:, time_to_point(nogating_t,0)].std(), g[:, time_to_point(gating_t, 0)].std())
+    nogating_SD, gating_SD = g_SDs
 
     nogating_sig = exp_nogating_sig
     gating_sig = exp_gating_sig
@@ -3471,11 +4910,14 @@ def test_several_sigmoids(g, covG, df, n=None):
     else:
         n_list = _np.random.randint(0, len(df.index), n)
 
+    # the SD of g at the fitting times is the same for all cells, compute it once rather than once per cell
+    g_SDs = (g[:, time_to_point(-.1, 0)].std(), g[:, time_to_point(.1, 0)].std())
+
     cond_discrete = []
     for i, n in enumerate(n_list):
         t0 = time()
         print("processing cell {0}".format(n))
-        cond_discrete.append(get_word_cond_discrete(g, covG, fit_exp_to_simulation(g, df, -.1, .1, cell=n)))
+        cond_discrete.append(get_word_cond_discrete(g, covG, fit_exp_to_simulation(g, df, -.1, .1, cell=n, g_SDs=g_SDs)))
         print("{0} took {1} secs to run".format(n, time()-t0))
 
     return cond_discrete
@@ -3679,7 +5121,7 @@ def wrap_gating_effect(g, letter_length, nl, binsN):
     nogating.tofile(os.path.join(datapath, 'nogating_effect_2L'))
 
 
-def load_model_fit():
+def load_model_fit(bank=False):
     '''
     In natural_scenes_fitting I loaded all PSTHs corresponding to a cell (all contrasts) and fitted a model where the threshold and peripheral_weight were variables.
 
@@ -3688,6 +5130,9 @@ def load_model_fit():
     Load that information and create and return a dictionary with cell # as key and a tuple with nonlinearity objects as values. Nonlinearities are of 'birect' form with just a threshold. Base nonlinearity uses nl_thresh as threshold and gated_nl has nl_thresh + peri_weight.
 
     dict[0] = (base_nonlinearity, gated_nonlinearity)
+
+    If bank is True, returns (cell_ids, base_bank, gated_bank) instead, where base_bank and gated_bank are nonlinear_bank
+    objects holding all base and gated nonlinearities (in the order of cell_ids), such that all of them are applied to g in one pass
     '''
     df = _pd.read_csv('UFlicker PSTHs/best_parameters.txt', sep=' ')
     
@@ -3699,6 +5144,9 @@ def load_model_fit():
 
         nls[df.iloc[i]['cell_id']] = (base_nl, gated_nl)
 
+    if bank:
+        return list(nls.keys()), nonlinear_bank(nls_to_list(nls, 'basal')), nonlinear_bank(nls_to_list(nls, 'gating'))
+
     return nls
 
 def nls_to_list(nls, sele = None):
@@ -3720,13 +5168,21 @@ def nls_to_list(nls, sele = None):
     return nl_list
 
 
-def load_sigmoids(s_file = 'UFlicker_sigmoids.txt', length=100, contrast=3):
+def load_sigmoids(s_file = 'UFlicker_sigmoids.txt', length=100, contrast=3, bank=False):
     '''
     Load all sigmoidal fits to gating cells from UFlicker experiment and convert them to nonlinear_block objects.
+
+    If bank is True, returns (basal_bank, gating_bank), two nonlinear_bank objects with all the sigmoids and all
+    their gating_nl, such that all of them are applied to g in one pass
     '''
 
     dataframe = _load_sigmoids_dataframe(s_file=s_file, length=length, contrast=contrast)
-    return _dataframe_to_nonlinear_block_list(dataframe)
+    sigmoids = _dataframe_to_nonlinear_block_list(dataframe)
+
+    if bank:
+        return nonlinear_bank(sigmoids), nonlinear_bank([sigmoid.gating_nl for sigmoid in sigmoids])
+
+    return sigmoids
 
 def _load_sigmoids_dataframe(s_file = 'UFlicker_sigmoids.txt', length=None, contrast=3):
     '''
@@ -4153,33 +5609,36 @@ def correlations_cartoon(bits_discrete, bits_noise):
     '''
     stim, noisy = _fake_correlated_stim(bits_discrete, bits_noise, 1000)
 
+    # all terms below share entropies of (shifted) stim and noisy, variables are (name, lag) and the value of
+    # ('stim', 1) at time point p is stim[p-1] (see entropy_cache). Terms are 0 before the largest lag and
+    # are sliced to keep the same time axis as before
+    cache = entropy_cache({'stim':stim, 'noisy':noisy})
+    s0, s1, s2 = [('stim', 0)], [('stim', 1)], [('stim', 2)]
+    n0 = [('noisy', 0)]
+
     # Info with 1 Letter word
-    info_0 = mi(stim,stim)
-    noisy_0 = mi(stim, noisy)
+    info_0 = cache.mi(s0, s0)
+    noisy_0 = cache.mi(s0, n0)
 
     # now compute the information that the perfectly linear encoder with 2 letters conveys about the correlated stim with the 2nd letter (newest)
-    info_L0 = mi(stim[1:], stim[:-1])
-    info_L1 = cond_mi(stim[1:], stim[1:], stim[:-1])
+    info_L0, info_L1 = cache.chain_rule(s0, 'stim', 2)[:, 1:]
 
     # Information of a 2-letter word about stim when noise is added
-    noisy_L0 = mi(stim[1:], noisy[:-1])
-    noisy_L1 = cond_mi(stim[1:], noisy[1:], noisy[:-1])
+    noisy_L0, noisy_L1 = cache.chain_rule(s0, 'noisy', 2)[:, 1:]
 
     # Information with a 3-letter word about the stim when noise is added
-    noisy_3L_L0 = mi(stim[2:], noisy[:-2])
-    noisy_3L_L1 = cond_mi(stim[2:], noisy[1:-1], noisy[:-2])
-    noisy_3L_L2 = cond_mi(stim[2:], noisy[2:], combine_labels(noisy[:-2], noisy[1:-1]))
+    noisy_3L_L0, noisy_3L_L1, noisy_3L_L2 = cache.chain_rule(s0, 'noisy', 3)[:, 2:]
 
     # Information with 1L with no noise but 2 frames
-    info_F0 = mi(stim[:-1], stim[1:])
-    info_F1 = cond_mi(stim[1:], stim[1:], stim[:-1])
-    noisy_F0 = mi(stim[:-1], noisy[1:])
-    noisy_F1 = cond_mi(stim[1:], noisy[1:], stim[:-1])
+    info_F0 = cache.mi(s1, s0)[1:]
+    info_F1 = cache.cond_mi(s0, s0, s1)[1:]
+    noisy_F0 = cache.mi(s1, n0)[1:]
+    noisy_F1 = cache.cond_mi(s0, n0, s1)[1:]
 
     # Information with a 3-frame stimulus and 1-L word when noise is added
-    noisy_3F_F0 = mi(stim[:-2], noisy[2:])
-    noisy_3F_F1 = cond_mi(stim[1:-1], noisy[2:], stim[:-2])
-    noisy_3F_F2 = cond_mi(stim[2:], noisy[2:], combine_labels(stim[:-2], stim[1:-1]))
+    noisy_3F_F0 = cache.mi(s2, n0)[2:]
+    noisy_3F_F1 = cache.cond_mi(s1, n0, s2)[2:]
+    noisy_3F_F2 = cache.cond_mi(s0, n0, s1+s2)[2:]
 
     _plt.close('correlations_cartoon')
     fig, ax = _plt.subplots(nrows=4, ncols=2, num='correlations_cartoon', sharex=True, sharey=True)
@@ -4440,7 +5899,7 @@ class nonlinear_block:
     def copy(self):
         return nonlinear_block(self.s_type, self.thresh, self.units, contrast=self.contrast, min_fr=self.min_fr, max_fr=self.max_fr, sd=self.sd, slope=self.slope)
 
-    def torate(self, linear_prediction, bin_rate=None):
+    def torate(self, linear_prediction, bin_rate=None, thresh=None, out=None):
         '''
         pass the linear prediction through the nonlinerity
 
@@ -4448,16 +5907,23 @@ class nonlinear_block:
                 1 input is in light units. Measured nonlinearities at different contrast will not overlay each other.
         
         bin_rate:   if bin_rate is given, responses are discretized by floor(rate/bin_rate)
-        '''
 
-        #_ipdb.set_trace()
+        thresh:     optional, overrides self.thresh. Can be an ndarray that broadcasts against linear_prediction,
+                    for example a threshold per time point (see cell.get_gating_letters)
 
-        # store original shape since map works on 1D objects and I will flatten the linear_prediction
-        shape_ori = linear_prediction.shape
+        out:        optional ndarray with the same shape as linear_prediction where the firing rate is written.
+                    Can be linear_prediction itself.
+        '''
 
+        #_ipdb.set_trace()
 
         # preallocate firing_rate ndarray
-        firing_rate = _np.zeros_like(linear_prediction)
+        linear_prediction = _np.asarray(linear_prediction)
+        if out is None:
+            dtype = linear_prediction.dtype if _np.issubdtype(linear_prediction.dtype, _np.floating) else float
+            firing_rate = _np.zeros(linear_prediction.shape, dtype=dtype)
+        else:
+            firing_rate = out
 
         if self.units=='sd of linear prediction':
             raise ValueError('not well implemented.')
@@ -4466,36 +5932,450 @@ class nonlinear_block:
             slope = self.slope*1.0/self.contrast
             sd = self.sd*1.0/self.contrast
         else:
-            thresh = self.thresh
+            if thresh is None:
+                thresh = self.thresh
             slope = self.slope
             sd = self.sd
 
         if sd==0 or slope==0:
+            firing_rate[...] = 0
             return firing_rate
 
         #_ipdb.set_trace()
+        # all operations are done in place on firing_rate, no other array the size of linear_prediction is allocated
+        _np.subtract(linear_prediction, thresh, out=firing_rate)
         if self.s_type == 'sigmoid':
             from scipy.special import expit
             # pass g through the nonlinearity. I'm using scipy.special.expit which is extremely fast, but requires changing the input according to threshold and sigma
-            firing_rate = expit((linear_prediction-thresh)/sd)*self.max_fr + self.min_fr
+            firing_rate /= sd
+            expit(firing_rate, out=firing_rate)
+            firing_rate *= self.max_fr
+            firing_rate += self.min_fr
         elif self.s_type == 'birect':
             '''
             lp1d = linear_prediction.flatten()
             firing_rate = _np.array(list(map(lambda x: 0 if x < thresh else slope*(x - thresh), lp1d))).reshape(shape_ori)
             '''
-            firing_rate = (linear_prediction-thresh)*slope
-            below_thresh_indices = firing_rate<0
-            firing_rate[below_thresh_indices] = 0
+            firing_rate *= slope
+            _np.maximum(firing_rate, 0, out=firing_rate)
 
         if bin_rate is not None:
-            firing_rate = _np.ceil(firing_rate/bin_rate)
+            firing_rate /= bin_rate
+            _np.ceil(firing_rate, out=firing_rate)
 
         return firing_rate
 
     def __copy__(self):
         return nonlinear_block(self.s_type, self.thresh, self.units, self.contrast, self.min_fr, self.max_fr, self.sd, self.slope)
 
-    
+
+
+class nonlinear_bank:
+    '''
+    Hold the parameters of many nonlinear_block objects as ndarrays and pass the same linear prediction
+    through all of them at once.
+
+    load_sigmoids, load_model_fit and the like produce dozens of nonlinear_block objects, applying each
+    one of them separately means one pass over g per object. Here g is traversed once (in blocks of rows)
+    and all nonlinearities are evaluated on each block with broadcasting.
+    '''
+    def __init__(self, nls):
+        '''
+        inputs:
+        -------
+            nls:    iterable of nonlinear_block objects. For example load_sigmoids() or
+                    [nl.gating_nl for nl in load_sigmoids()] or nls_to_list(load_model_fit(), 'basal')
+        '''
+        nls = list(nls)
+        if len(nls) == 0:
+            raise ValueError('nonlinear_bank needs at least one nonlinear_block')
+
+        if any([nl.units != 'linear prediction' for nl in nls]):
+            raise ValueError('nonlinear_bank only implements units = "linear prediction"')
+
+        self.nls = nls
+
+        # parameters as 1D ndarrays, element i corresponds to nls[i]
+        self.is_sigmoid = _np.array([nl.s_type == 'sigmoid' for nl in nls])
+        self.thresh = _np.array([nl.thresh for nl in nls], dtype=float)
+        self.slope  = _np.array([nl.slope for nl in nls], dtype=float)
+        self.sd     = _np.array([nl.sd for nl in nls], dtype=float)
+        self.min_fr = _np.array([nl.min_fr for nl in nls], dtype=float)
+        self.max_fr = _np.array([nl.max_fr for nl in nls], dtype=float)
+
+        # nonlinear_block.torate returns all zeros when either sd or slope are 0
+        self.is_null = (self.sd == 0) | (self.slope == 0)
+
+        # runs of consecutive nonlinearities of the same kind ('sigmoid', 'birect' or 'null'), as (kind, slice).
+        # Each run is evaluated on a view of the output (rates[run]), no block is copied
+        kinds = _np.where(self.is_null, 'null', _np.where(self.is_sigmoid, 'sigmoid', 'birect'))
+        edges = _np.flatnonzero(kinds[1:] != kinds[:-1]) + 1
+        self._runs = [(str(kinds[start]), slice(int(start), int(end))) for start, end in zip(_np.r_[0, edges], _np.r_[edges, len(nls)])]
+
+    def __len__(self):
+        return len(self.nls)
+
+    def torate(self, linear_prediction, bin_rate=None, rows_per_chunk=1000):
+        '''
+        pass linear_prediction through every nonlinearity in the bank
+
+        inputs:
+        -------
+            linear_prediction:  ndarray, for example g (cells x time)
+
+            bin_rate:           if given, responses are discretized by ceil(rate/bin_rate) as in nonlinear_block.torate
+
+            rows_per_chunk:     number of rows of linear_prediction evaluated at once. Temporaries are of size
+                                len(self) x rows_per_chunk x linear_prediction.shape[1]
+
+        output:
+        -------
+            rates:              ndarray of shape (len(self),) + linear_prediction.shape
+                                rates[i] is the same as self.nls[i].torate(linear_prediction, bin_rate)
+        '''
+        linear_prediction = _np.asarray(linear_prediction)
+        dtype = linear_prediction.dtype if _np.issubdtype(linear_prediction.dtype, _np.floating) else float
+        rates = _np.empty((len(self),) + linear_prediction.shape, dtype=dtype)
+
+        if linear_prediction.ndim < 2:
+            self._torate_block(linear_prediction, rates, bin_rate)
+            return rates
+
+        for start in range(0, linear_prediction.shape[0], rows_per_chunk):
+            end = start + rows_per_chunk
+            self._torate_block(linear_prediction[start:end], rates[:, start:end], bin_rate)
+
+        return rates
+
+    def tocodes(self, linear_prediction, bins, rows_per_chunk=1000):
+        '''
+        pass linear_prediction through every nonlinearity in the bank and bin the responses without
+        keeping the rates.
+
+        inputs:
+        -------
+            bins:       either a 1D ndarray with bin edges shared by all nonlinearities or a 2D ndarray where
+                        bins[i] are the edges for self.nls[i]. Binning is done as in _np.digitize(rate, bins)
+
+        output:
+        -------
+            codes:      uint8 (uint16 if needed) ndarray of shape (len(self),) + linear_prediction.shape
+        '''
+        linear_prediction = _np.asarray(linear_prediction)
+        bins = _np.asarray(bins)
+        if bins.ndim == 1:
+            bins = _np.tile(bins, (len(self), 1))
+
+        dtype = _np.uint8 if bins.shape[1] < 256 else _np.uint16
+        codes = _np.empty((len(self),) + linear_prediction.shape, dtype=dtype)
+
+        if linear_prediction.ndim < 2:
+            linear_prediction = linear_prediction.reshape(1, -1)
+            codes_2d = codes.reshape(len(self), 1, -1)
+        else:
+            codes_2d = codes
+
+        for start in range(0, linear_prediction.shape[0], rows_per_chunk):
+            end = start + rows_per_chunk
+            rates = self.torate(linear_prediction[start:end], rows_per_chunk=rows_per_chunk)
+            for i in range(len(self)):
+                codes_2d[i, start:end] = _np.searchsorted(bins[i], rates[i], side='right')
+
+        return codes
+
+    def _torate_block(self, lp, rates, bin_rate):
+        '''
+        compute rates for all nonlinearities in the bank on a block of linear predictions.
+        rates has shape (len(self),) + lp.shape and is modified in place
+        '''
+        # reshape parameters to broadcast against lp
+        shape = (-1,) + (1,)*lp.ndim
+
+        for kind, run in self._runs:
+            out = rates[run]
+            if kind == 'null':
+                out[...] = 0
+            elif kind == 'sigmoid':
+                from scipy.special import expit
+                _np.subtract(lp, self.thresh[run].reshape(shape), out=out)
+                out /= self.sd[run].reshape(shape)
+                expit(out, out=out)
+                out *= self.max_fr[run].reshape(shape)
+                out += self.min_fr[run].reshape(shape)
+            else:
+                _np.subtract(lp, self.thresh[run].reshape(shape), out=out)
+                out *= self.slope[run].reshape(shape)
+                _np.maximum(out, 0, out=out)
+
+        if bin_rate is not None:
+            rates /= bin_rate
+            _np.ceil(rates, out=rates)
+
+
+class percentile_binner:
+    '''
+    Bin data into binsN symbols using percentiles.
+
+    Bins are defined once, either from a time window of an array (fit) or by streaming data through
+    partial_fit (a uniform random subsample of at most max_samples values is kept to compute percentiles).
+    Then any array can be binned, block by block, with transform.
+    Binning is the same as _np.digitize(x, bins), values are in range(binsN+2) and stored as uint8
+    (uint16 if binsN > 254)
+
+    The sorted reference data is also kept. ranks() returns the rank of each value relative to it, and
+    codes for any number of bins follow from the ranks with integer arithmetic (see codes_from_ranks, exact for
+    the reference values and approximate for other time points)
+    '''
+    def __init__(self, binsN, max_samples=10**6):
+        '''
+        inputs:
+        -------
+            binsN:          number of bins (percentiles are at 0, 100/binsN, ..., 100)
+
+            max_samples:    maximum number of values kept by partial_fit to compute percentiles
+        '''
+        self.binsN = binsN
+        self.max_samples = max_samples
+        self.bins = None
+        self.reference = None
+
+        # values and random keys kept by partial_fit
+        self._samples = _np.zeros(0)
+        self._keys = _np.zeros(0)
+
+    def fit(self, values, points=None):
+        '''
+        define the bins from the percentiles of values
+
+        inputs:
+        -------
+            values:     ndarray, for example noisy_g at letter resolution
+
+            points:     optional, int or iterable of ints. If given, only values[:, points] (a time window) are used
+
+        output:
+        -------
+            self
+        '''
+        values = _np.asarray(values)
+        if points is not None:
+            values = values[:, points]
+
+        # percentiles are always computed in float64 (see sim_dtype)
+        self.reference = _np.sort(values.astype(float).ravel())
+        self.bins = _np.percentile(self.reference, self._percentiles())
+
+        return self
+
+    def partial_fit(self, values):
+        '''
+        add 'values' to the data used to define the bins and update the bins. Call it once per block of data
+
+        Implementation notes:
+            each value gets a uniform random key and the max_samples values with the smallest keys are kept.
+            That is a uniform subsample without replacement of all the values seen so far.
+        '''
+        values = _np.asarray(values, dtype=float).ravel()
+
+        samples = _np.concatenate((self._samples, values))
+        keys = _np.concatenate((self._keys, _np.random.rand(len(values))))
+
+        if len(samples) > self.max_samples:
+            kept = _np.argpartition(keys, self.max_samples)[:self.max_samples]
+            samples = samples[kept]
+            keys = keys[kept]
+
+        self._samples = samples
+        self._keys = keys
+        self.reference = _np.sort(samples)
+        self.bins = _np.percentile(self.reference, self._percentiles())
+
+        return self
+
+    def ranks(self, values, rows_per_chunk=10000):
+        '''
+        rank of every value relative to the reference data (the number of reference values <= value)
+
+        output:
+        -------
+            ranks:  ndarray, same shape as values, uint16 (uint32 if there are 2**16 or more reference values)
+                    with values in range(len(self.reference)+1)
+        '''
+        if self.reference is None:
+            raise ValueError('percentile_binner: call fit or partial_fit before ranks')
+
+        values = _np.asarray(values)
+        dtype = _np.uint16 if len(self.reference) < 2**16 else _np.uint32
+        ranks = _np.empty(values.shape, dtype=dtype)
+
+        if values.ndim < 2:
+            ranks[...] = _np.searchsorted(self.reference, values, side='right')
+            return ranks
+
+        for start in range(0, values.shape[0], rows_per_chunk):
+            end = start + rows_per_chunk
+            ranks[start:end] = _np.searchsorted(self.reference, values[start:end], side='right')
+
+        return ranks
+
+    def transform(self, values, rows_per_chunk=10000):
+        '''
+        bin values with the bins defined in fit/partial_fit
+
+        output:
+        -------
+            codes:  ndarray, same shape as values, uint8 (or uint16). codes = _np.digitize(values, self.bins)
+        '''
+        if self.bins is None:
+            raise ValueError('percentile_binner: call fit or partial_fit before transform')
+
+        values = _np.asarray(values)
+        codes = _np.empty(values.shape, dtype=self.dtype())
+
+        if values.ndim < 2:
+            codes[...] = _np.searchsorted(self.bins, values, side='right')
+            return codes
+
+        for start in range(0, values.shape[0], rows_per_chunk):
+            end = start + rows_per_chunk
+            codes[start:end] = _np.searchsorted(self.bins, values[start:end], side='right')
+
+        return codes
+
+    def dtype(self):
+        '''
+        smallest unsigned integer type that holds all binsN+2 symbols
+        '''
+        return _np.uint8 if self.binsN + 2 <= 256 else _np.uint16
+
+    def save(self, path):
+        '''
+        save the bins (float64) to 'path' and the sorted reference data to 'path'_reference
+        '''
+        self.bins.tofile(path)
+        if self.reference is not None:
+            self.reference.tofile(path + '_reference')
+
+    def load(self, path):
+        '''
+        load bins saved with 'save' from 'path'. binsN is redefined from the bins
+        '''
+        self.bins = _np.fromfile(path)
+        self.binsN = len(self.bins) - 1
+
+        if os.path.isfile(path + '_reference'):
+            self.reference = _np.fromfile(path + '_reference')
+
+        return self
+
+    def _percentiles(self):
+        return list(_np.arange(0, 100.1, 100/self.binsN))
+
+class covariance_accumulator:
+    '''
+    Streaming covariance of the columns of a 2D array that is only ever seen in row blocks (for example g, one image
+    at a time). I keep the number of rows, the mean and the sum of squared deviations M2 (all in float64) and merge
+    every new block with Chan et al.'s pairwise update:
+
+        delta = mean_b - mean_a
+        n     = n_a + n_b
+        mean  = mean_a + delta * n_b / n
+        M2    = M2_a + M2_b + outer(delta, delta) * n_a * n_b / n
+
+    which is numerically stable and does not depend on the order in which blocks arrive, so accumulators filled by
+    different processes (images) can be merged with 'merge' to give the same covariance as computing it on all rows.
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.M2 = None
+
+    def update(self, block):
+        '''
+        incorporate the rows of the 2D array 'block' (rows are samples, columns are variables, ie: cells x time for g)
+        '''
+        block = _np.asarray(block, dtype=float)
+        if block.ndim == 1:
+            block = block[_np.newaxis, :]
+
+        if len(block) == 0:
+            return self
+
+        other = covariance_accumulator()
+        other.n = len(block)
+        other.mean = block.mean(axis=0)
+        centered = block - other.mean
+        other.M2 = _np.dot(centered.T, centered)
+
+        return self.merge(other)
+
+    def merge(self, other):
+        '''
+        merge the partial sums of another covariance_accumulator into this one (in place)
+        '''
+        if other.n == 0:
+            return self
+
+        if self.n == 0:
+            self.n = other.n
+            self.mean = other.mean.copy()
+            self.M2 = other.M2.copy()
+            return self
+
+        if self.mean.shape != other.mean.shape:
+            raise ValueError('can not merge accumulators with {0} and {1} variables'.format(len(self.mean), len(other.mean)))
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.M2 += other.M2 + _np.outer(delta, delta) * (self.n * other.n / n)
+        self.n = n
+
+        return self
+
+    def cov(self, ddof=1):
+        '''
+        return the covariance matrix, same normalization as _np.cov (ddof=1 by default)
+        '''
+        if self.n - ddof <= 0:
+            raise ValueError('need more than {0} samples to compute the covariance, got {1}'.format(ddof, self.n))
+
+        return self.M2 / (self.n - ddof)
+
+    def save(self, path, ddof=1, tags=()):
+        '''
+        save the covariance (float64) to 'path', the mean to 'path'_mean and the metadata needed to interpret
+        and keep on merging them to 'path'_metadata:
+            [number of samples, ddof, sim_start_t, sim_end_t, sim_delta_t, *tags]
+
+        tags:   iterable of numbers describing what the samples are (for example the number of images and of
+                cells per image used to compute g), 'load' refuses the file if they don't match
+        '''
+        self.cov(ddof).tofile(path)
+        self.mean.tofile(path + '_mean')
+        _np.array([self.n, ddof, sim_start_t, sim_end_t, sim_delta_t] + list(tags), dtype=float).tofile(path + '_metadata')
+
+    def load(self, path, tags=()):
+        '''
+        load an accumulator saved with 'save' from 'path'. M2 is recovered from the covariance so that
+        more blocks can be added afterwards.
+
+        Raises ValueError if the simulation time axis or the tags in the metadata differ from the current ones.
+        '''
+        metadata = _np.fromfile(path + '_metadata')
+        if not _np.allclose(metadata[2:5], [sim_start_t, sim_end_t, sim_delta_t]):
+            raise ValueError('{0} was computed with time axis (start, end, delta) = {1}, current one is {2}'.format(
+                path, tuple(metadata[2:5].tolist()), (sim_start_t, sim_end_t, sim_delta_t)))
+
+        if len(metadata[5:]) != len(tags) or not _np.allclose(metadata[5:], tags):
+            raise ValueError('{0} was computed with tags {1}, requested {2}'.format(path, tuple(metadata[5:].tolist()), tuple(tags)))
+
+        self.n = int(metadata[0])
+        self.mean = _np.fromfile(path + '_mean')
+        self.M2 = _np.fromfile(path).reshape(len(self.mean), len(self.mean)) * (self.n - metadata[1])
+
+        return self
+
 class adaptation_block:
     '''
     Define an adaptive block, for the time being I'm only implementing dividing by memory+offset
@@ -4536,32 +6416,71 @@ class adaptation_block:
         # before convolving make memory_array of unit norm
         #self.memory_array /= norm(self.memory_array)
 
-    def adapt(self, signal, del_flag=0):
+    def adapt(self, signal, del_flag=0, initial='zero', state=None, return_state=False):
         '''
         signal is probably going to be [Ca]. Divide signal by the result of convolving signal with a decaying exponential with 'memory' and adding an offset
 
-        signal can be 1d array or nd array. Last dimension is the time dimension to be convolved by the decaying exponential
+        signal can be 1d array or nd array. Last dimension is the time dimension to be convolved by the decaying exponential.
+        Each row is filtered on its own, rows don't bleed into each other.
+
+        inputs:
+        -------
+            del_flag:       if set, the first len(self.memory_array)-1 points of every row are removed from the output.
+                            Only needed if those points are not trusted because of the initial state (see 'initial')
+
+            initial:        defines the memory before the first point of each row (ignored if 'state' is given)
+                            'zero':     signal was 0 before the first point
+                            'first':    signal was constant and equal to its first point (adapted steady state)
+                            'mean':     signal was constant and equal to the row's mean
+
+            state:          ndarray with shape signal.shape[:-1], the memory just before the first point of each row.
+                            Used for streaming, pass the state returned by the previous call (with return_state=True)
+
+            return_state:   if True, also return the memory at the last point of each row
+
+        output:
+        -------
+            adapted:        signal / (memory + offset)
 
-        by convolving, 
+            state:          only if return_state, ndarray with shape signal.shape[:-1]
+
+        Implementation notes:
+            Convolving with a decaying exponential a**k (with a = exp(-delta_t/memory), normalized to sum 1) is the
+            same as running a one pole filter along the time axis
+                memory[n] = a * memory[n-1] + (1-a) * signal[n]
+            which is O(N) regardless of self.memory. The exponential is not truncated (memory_array was truncated
+            where the exponential dropped to 0.01 of its first value)
         '''
+        from scipy.signal import lfilter
 
         #_ipdb.set_trace()
-        N = len(self.memory_array)
-        # convolve signal with memory_array. I work on a flatten version of array
-        convolution = _np.convolve(signal.flatten(), self.memory_array)
+        signal = _np.asarray(signal)
+        a = _np.exp(-self.delta_t/self.memory)
+
+        if state is None:
+            if initial == 'zero':
+                state = _np.zeros(signal.shape[:-1])
+            elif initial == 'first':
+                state = signal[..., 0]
+            elif initial == 'mean':
+                state = signal.mean(axis=-1)
+            else:
+                raise ValueError('initial has to be "zero", "first" or "mean"')
 
-        # now convolution has len(memory_array) + len(signal.flatten()) points. I'm discarding points from the end to keep convolution the same size as signal.
-        # Then I'm reshaping it to be the original size. 
-        convolution = convolution[:- N +1].reshape(signal.shape)
+        # lfilter's state is a * memory[-1]
+        zi = a * _np.asarray(state, dtype=float).reshape(signal.shape[:-1] + (1,))
+        memory, zf = lfilter([1-a], [1, -a], signal, axis=-1, zi=zi)
+
+        adapted = _np.divide(signal, memory + self.offset)
 
         if del_flag:
-            # From every row now, the first len(memory_array)-1 points are trash because the filter is overlaping signal from different cells. After reshaping to signal's original shape, remove those columns
-            convolution = _np.delete(convolution, range(N-1), convolution.ndim-1)
+            N = len(self.memory_array)
+            adapted = _np.delete(adapted, range(N-1), adapted.ndim-1)
 
-            signal = _np.delete(signal, range(N-1), signal.ndim-1)
+        if return_state:
+            return adapted, zf[..., 0]/a
 
-        # divide signal by convolution + offset. Convolution is longer than signal by len(memory_array)-1 points that were added to the front. That's why in the following line I have convolution[len(memory_array)-1:]
-        return _np.divide(signal, convolution + self.offset)
+        return adapted
 
 
 class filter_block:
@@ -4697,65 +6616,147 @@ class cell:
         self.adaptation = adaptation_block(adaptation_type, adaptation_memory, llength/1000, adaptation_offset)
 
 
-    def processAllImages(self, folders, maxImages=None, maxCellsPerImage=None):
+    def processAllImages(self, folders, maxImages=None, maxCellsPerImage=None, keep_g=True):
         '''
         Compute the linear prediction of this cell as defined by parameters in self.center, self.surround, when the cell moves over many images from Tkacik's data base
         Cells are moving according to a FEM + a saccade that happens at time 0.
         Time in the simulation is defined by sim_start_t, sim_end_t and sim_delta_t, the time axis is tax = arange(sim_start_t, sim_end_t, sim_delta_t)
 
+        The covariance of g (covG) is accumulated image by image with a covariance_accumulator and saved under
+        folders['FEM']/covG (see covariance_accumulator.save), tagged with the number of images and of cells per image
+        used so that get_covG does not mix up runs with different settings
+
         inputs:
         -------
             maxImages:          integer, optional parameter defining the maximum number of images to use
                                 defaults to None, meaning use all images
+
+            keep_g:             bool, if False g is never materialized, each image is simulated into a buffer of
+                                maxCellsPerImage rows that only feeds the covariance, and covG is returned instead of g.
+                                Use it when only the gaussian analysis is needed (see get_covG)
         
         outpus:
         -------
             g:                  2D ndarray, the linear prediction of many identical cells over many images
                                 g[i][:]     is the linear prediction of cell i over time
                                 g[:][t0]    is the linear prediction of all cells and all images at time t0
+
+                                if keep_g is False, covG (2D ndarray, time x time) is returned instead
         '''
         #_ipdb.set_trace()
 
         # try loading 'linear_prediction' if that fails, compute it
         linear_pred_path = os.path.join(folders['FEM'], 'linear_prediction')
-        if os.path.isfile(linear_pred_path):
-            g = _np.fromfile(linear_pred_path).reshape(-1,300)
+        if keep_g and (os.path.isfile(_dtype_path(linear_pred_path)) or os.path.isfile(linear_pred_path)):
+            g = _fromfile(linear_pred_path).reshape(-1,300)
             return g
 
-        if images_list is None:
-            _getImagesPath()
-        
-
-        # estimate number of cells per image
-        if maxCellsPerImage is None:
-            centerD = self.center.size*pixperdegree
-            imSize = _loadImage(0).shape
-            maxCellsPerImage = _np.floor(imSize[0]/centerD)*_np.floor(imSize[1]/centerD)
+        imagesN, maxCellsPerImage = self._images_settings(maxImages, maxCellsPerImage)
 
         # compute time axis of simulation
         tax = _get_simulation_TAX()
 
-        # preallocate array for all linear predictions
-        g = _np.zeros((maxCellsPerImage*len(images_list), len(tax)))
+        # preallocate array for all linear predictions (or just for one image if g is not kept)
+        # and the image each cell was simulated on (used to compute jackknife error bars, see resampled_mi)
+        if keep_g:
+            g = _np.zeros((maxCellsPerImage*imagesN, len(tax)), dtype=sim_dtype)
+            image_ids = _np.zeros(len(g), dtype=int)
+        else:
+            g = _np.zeros((maxCellsPerImage, len(tax)), dtype=sim_dtype)
+
+        covG = covariance_accumulator()
     
         #_ipdb.set_trace()
         nextCell = 0
-        for imNumber in range(len(images_list)):
-            if imNumber == maxImages:
-                break
-            
+        for imNumber in range(imagesN):
             print(images_list[imNumber])
             t = _time()
-            nextCell = self._processOneImage(imNumber, g, nextCell, maxCellsPerImage)
-            print('\t{0} cells processed in {1} secs'.format(nextCell, _time()-t))
+            firstCell = nextCell if keep_g else 0
+            nextCell = self._processOneImage(imNumber, g, firstCell, maxCellsPerImage)
+            if keep_g:
+                image_ids[firstCell:nextCell] = imNumber
+            covG.update(g[firstCell:nextCell])
+            print('\t{0} cells processed in {1} secs'.format(covG.n, _time()-t))
+
+        covG.save(os.path.join(folders['FEM'], 'covG'), tags=(imagesN, maxCellsPerImage))
+
+        if not keep_g:
+            return covG.cov()
 
         g = g[:nextCell][:]
-        if not os.path.isdir(sacc_path):
-            os.makedirs(sacc_path)
-        g.tofile(folders['FEM'])
+        g.tofile(_dtype_path(linear_pred_path))
+        image_ids[:nextCell].tofile(os.path.join(folders['FEM'], 'image_ids'))
 
         return g
 
+    def get_covG(self, folders, maxImages=None, maxCellsPerImage=None, block_size=10000):
+        '''
+        Return the covariance of the linear prediction g (time x time) without loading g in memory.
+
+        I try, in order:
+            1. loading folders['FEM']/covG (saved by processAllImages)
+            2. streaming folders['FEM']/linear_prediction from disk in blocks of 'block_size' cells
+            3. simulating all images with processAllImages(..., keep_g=False)
+        and in cases 2 and 3 covG is saved under folders['FEM']/covG for next time.
+
+        covG and linear_prediction are only used if they were computed with the same number of images and
+        of cells per image requested here (see processAllImages), the time axis of covG is checked as well.
+        '''
+        imagesN, maxCellsPerImage = self._images_settings(maxImages, maxCellsPerImage)
+        tags = (imagesN, maxCellsPerImage)
+
+        covG_path = os.path.join(folders['FEM'], 'covG')
+        if os.path.isfile(covG_path + '_metadata'):
+            try:
+                return covariance_accumulator().load(covG_path, tags).cov()
+            except ValueError as error:
+                print('{0}, recomputing it'.format(error))
+
+        # linear_prediction does not record the settings it was computed with but image_ids (saved along with
+        # it) does: images 0 to imagesN-1 and at most maxCellsPerImage cells per image
+        linear_pred_path = os.path.join(folders['FEM'], 'linear_prediction')
+        image_ids_path = os.path.join(folders['FEM'], 'image_ids')
+        image_ids = _np.fromfile(image_ids_path, dtype=int) if os.path.isfile(image_ids_path) else _np.zeros(0, dtype=int)
+        consistent = len(image_ids) and image_ids.max() + 1 == imagesN and _np.bincount(image_ids).max() <= maxCellsPerImage
+
+        if consistent and os.path.isfile(_dtype_path(linear_pred_path)):
+            g = _np.memmap(_dtype_path(linear_pred_path), dtype=sim_dtype, mode='r')
+        elif consistent and os.path.isfile(linear_pred_path):
+            g = _np.memmap(linear_pred_path, dtype=float, mode='r')
+        else:
+            return self.processAllImages(folders, maxImages, maxCellsPerImage, keep_g=False)
+
+        g = g.reshape(-1, 300)
+        covG = covariance_accumulator()
+        for start in range(0, len(g), block_size):
+            covG.update(g[start:start+block_size])
+
+        covG.save(covG_path, tags=tags)
+        return covG.cov()
+
+    def _images_settings(self, maxImages=None, maxCellsPerImage=None):
+        '''
+        Resolve the defaults of processAllImages
+
+        output:
+        -------
+            imagesN:            number of images that will be used, all images in images_list unless maxImages is given
+
+            maxCellsPerImage:   as given or, if None, as many non overlapping centers as fit in an image
+        '''
+        if images_list is None:
+            _getImagesPath()
+
+        imagesN = len(images_list) if maxImages is None else min(maxImages, len(images_list))
+
+        # estimate number of cells per image
+        if maxCellsPerImage is None:
+            centerD = self.center.size*pixperdegree
+            imSize = _loadImage(0).shape
+            maxCellsPerImage = int(_np.floor(imSize[0]/centerD)*_np.floor(imSize[1]/centerD))
+
+        return imagesN, maxCellsPerImage
+
 
     def _processOneImage(self, imNumber, g, nextCell, maxCells=None):
         '''
@@ -4936,12 +6937,18 @@ class cell:
         noise_file = os.path.join(folder, 'linear_prediction_noise')
         #_ipdb.set_trace()
         try:
-            noise = _np.fromfile(noise_file).reshape(shape)
+            noise = _fromfile(noise_file).reshape(shape)
             print('Noise loaded from "{0}" file'.format(noise_file))
             return noise
         except:
             if corr_time is None:
-                noise = _np.random.randn(*shape)                        # here 'np' is numpy, not a typo
+                # generate noise in blocks of rows, such that with sim_dtype = 'float32' there is never a float64 array
+                # the size of g. Random numbers are the same as in _np.random.randn(*shape)
+                noise = _np.empty(shape, dtype=sim_dtype)
+                flat_noise = noise.reshape(-1)
+                block = 10**7
+                for start in range(0, noise.size, block):
+                    flat_noise[start:start+block] = _np.random.randn(min(block, noise.size-start))  # here 'np' is numpy, not a typo
             else:
                 raise ValueError("""
                     This is not fully implemented, noise data should be saved
@@ -4952,14 +6959,15 @@ class cell:
                 #_ipdb.set_trace()
                 noise -= noise.mean()
                 noise /= noise.std()
+                noise = noise.astype(sim_dtype, copy=False)
 
         if save_flag:
             N = 4
             print('*'*72)
-            print('*'+' '*N + 'Saving {0}'.format(noise_file) + ' '*N + '*')
+            print('*'+' '*N + 'Saving {0}'.format(_dtype_path(noise_file)) + ' '*N + '*')
             print('*'*72)
 
-            noise.tofile(noise_file)
+            noise.tofile(_dtype_path(noise_file))
 
         return noise
 
@@ -5022,42 +7030,45 @@ class cell:
         return central_mp + gating_mp
 
 
-    def get_gating_letters(self, lp):
+    def get_gating_letters(self, lp, out=None):
         '''
         Pass linear prediction 'lp', through the corresponding nonlinearity to get gating latters. Corresponding nl is a combination of nl_basal plus a shift, where the shift is given by peripheral.kernel
 
         lp:     2D ndarray where lp[i,j] represents cell i, point in time j (and j = 0 corresponds to sim_start_t and j=-1 to sim_end_t)
 
+        out:    optional ndarray, same shape as lp, where gating letters are written (can be lp itself)
+
         At this point, lp time is in sim_delta_t and NOT in letter_length
+
+        Implementation notes:
+            Rather than looping through time and making a new nl at each point, I build the threshold
+            at every time point once (see _get_gating_threshold) and pass all of lp through
+            self.nl_basal at once, the threshold broadcasts along the time axis.
         '''
         #_ipdb.set_trace()
 
-        # grab peripheral contribution
-        kernel = self.periphery.kernel*nl_gating_amplitud
-        """
-        _plt.figure()
-        tax = _np.arange(0, len(kernel)*.005, .005)
-        _plt.plot(tax, kernel)
-        """
-        # preallocate gating letters
-        gating_letters = _np.zeros_like(lp)
+        thresh = self._get_gating_threshold(lp.shape[-1])
+
+        return self.nl_basal.torate(lp, thresh=thresh, out=out)
 
-        # loop through the time axis of lp (axis=1), compute the nl according to the threshold and pass lp through it
-        for p in range(lp.shape[1]):
-            # convert p from lp to a shift.
-            # first convert p to time in lp and constrain it to be in the kernel range, then convert it to a shift
-            t = p*sim_delta_t + sim_start_t
-            if t < 0 or t >.45:         # not important to distinguish between less than 0 or more than .45 since both have the same shift (0)
-                t = 0
+    def _get_gating_threshold(self, points):
+        '''
+        Return a 1D ndarray with the threshold of the gating nonlinearity at each of the first 'points' time points of the simulation.
 
-            kernel_pnt = t/sim_delta_t
-            shift = kernel[kernel_pnt]
+        The threshold is self.nl_basal.thresh minus the peripheral contribution (periphery.kernel * nl_gating_amplitud).
+        Periphery kernel is designed to be excitatory during gating. Since I'm modeling it as a threshold shift, the threshold
+        has to shift in the opposite direction (decreasing to get excitation)
+        '''
+        # grab peripheral contribution
+        kernel = self.periphery.kernel*nl_gating_amplitud
 
-            nl = self.nl_basal.copy()
-            nl.thresh -= shift              # periphery kernel is designed to be excitatory during gating. Since I'm modeling it as a threshold shift, the threshold has to shift in the opposite direction (decreasing to get excitation)
-            gating_letters[:,p] = nl.torate(lp[:,p])
+        # convert each point to time, and constrain it to be in the kernel range, then convert it to a point in the kernel.
+        # not important to distinguish between less than 0 or more than .45 since both have the same shift (kernel[0] = 0)
+        t = _np.arange(points)*sim_delta_t + sim_start_t
+        t[(t < 0) | (t > .45)] = 0
+        kernel_pnt = _np.rint(t/sim_delta_t).astype(int)
 
-        return gating_letters
+        return self.nl_basal.thresh - kernel[kernel_pnt]
 
     def get_ca_concentration(self):
         self.nl.torate